@@ -3,20 +3,51 @@ from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 
+from .json_provider import OrjsonProvider
+from .fast_ingest import IngestBatchFastPath
+
+try:
+    from whitenoise import WhiteNoise
+except ImportError:  # Flask's own /static route serves the same files
+    WhiteNoise = None
+
+from .routes.ui import ui_bp
+from .routes.ingest import ingest_bp
+from .routes.profiles import profiles_bp
+from .routes.gemini import gemini_bp
+
+# Comma-separated list of origins allowed to call the API cross-origin
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv('ALLOWED_ORIGINS', '').split(',') if o.strip()]
+CORS_API_PATHS = (
+    r"/ingest.*",
+    r"/latest_esp32",
+    r"/esp32_data",
+    r"/(save_profile|profiles|delete_profile|live_status)",
+    r"/gemini-analyze.*",
+    r"/(session-preview|latest-data-range|validate-time-range|api-key-status)",
+)
+
 def create_app():
     app = Flask(__name__)
-    app.config['DEBUG'] = True
-    app.config['PROPAGATE_EXCEPTIONS'] = True
+    app.json = OrjsonProvider(app)
+    # Debug mode (reloader, debugger, propagated exceptions) is opt-in via env
+    app.config['DEBUG'] = os.getenv('FLASK_DEBUG', '0') == '1'
+    app.config['PROPAGATE_EXCEPTIONS'] = os.getenv('PROPAGATE_EXCEPTIONS', '0') == '1'
+    # Behind nginx/Apache, let the proxy stream send_file() responses with
+    # sendfile(2) (X-Sendfile / X-Accel-Redirect) instead of copying through Python
+    app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
     
-    # Session Config
+    # Session Config: Flask's signed-cookie sessions. The payload is tiny
+    # (user id, email, name), so no server-side store is needed and every
+    # worker can validate it without touching disk.
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev_key')
-    app.config['SESSION_TYPE'] = 'filesystem'
     app.config['SESSION_PERMANENT'] = False
     
-    from flask_session import Session
-    Session(app)
-    
-    CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+    # CORS only for the JSON API and only for explicitly allowed front-end
+    # origins; the bundled UI is served same-origin and needs none.
+    if ALLOWED_ORIGINS:
+        CORS(app, resources={path: {"origins": ALLOWED_ORIGINS} for path in CORS_API_PATHS},
+             supports_credentials=True)
     
     app.wsgi_app = ProxyFix(
         app.wsgi_app,
@@ -25,14 +56,14 @@ def create_app():
         x_host=1,
         x_port=1
     )
+    # Bundled assets under /static/ bypass Flask entirely when WhiteNoise is installed
+    if WhiteNoise is not None:
+        app.wsgi_app = WhiteNoise(app.wsgi_app, root=app.static_folder, prefix='static/')
+    # Device batch uploads are answered before Flask's routing and request context
+    app.wsgi_app = IngestBatchFastPath(app.wsgi_app)
     
     
-    # Import and register blueprints
-    from .routes.ui import ui_bp
-    from .routes.ingest import ingest_bp
-    from .routes.profiles import profiles_bp
-    from .routes.gemini import gemini_bp
-    
+    # Register blueprints
     app.register_blueprint(ui_bp)
     app.register_blueprint(ingest_bp)
     app.register_blueprint(profiles_bp)
@@ -1,49 +1,108 @@
-from flask import session, redirect, url_for, request, jsonify
+from flask import g, session, redirect, url_for, request, jsonify
 from functools import wraps
+import logging
+from threading import Lock
+from cachetools import TTLCache
 import os
 import requests
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
-from app.db import get_db
+from app.db import get_db, readonly_db, prepare
+
+logger = logging.getLogger(__name__)
 
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 
+# One keep-alive HTTP session for Google token verification, so logins reuse
+# the TLS connection (and google-auth's cached certs) instead of reconnecting.
+_http_session = requests.Session()
+_http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_google_request = google_requests.Request(session=_http_session)
+
+# api_key -> user_id. Keys are looked up on nearly every ESP32 request, so
+# cache hits for a minute and misses briefly (to blunt brute-force probing).
+_api_key_cache = TTLCache(maxsize=10_000, ttl=60)
+_unknown_api_key_cache = TTLCache(maxsize=10_000, ttl=10)
+_api_key_lock = Lock()
+
+def _lookup_api_key(api_key):
+    with readonly_db() as conn:
+        prepare(conn, "verify_api_key_stmt", ["varchar"], "SELECT id FROM users WHERE api_key = $1")
+        cur = conn.cursor()
+        try:
+            cur.execute("EXECUTE verify_api_key_stmt (%s)", (api_key,))
+            user = cur.fetchone()
+            if user:
+                return user[0]
+            return None
+        finally:
+            cur.close()
+
 def verify_api_key(api_key):
-    conn = get_db()
-    cur = conn.cursor()
+    with _api_key_lock:
+        user_id = _api_key_cache.get(api_key)
+        if user_id is not None:
+            return user_id
+        if api_key in _unknown_api_key_cache:
+            return None
+
     try:
-        cur.execute("SELECT id FROM users WHERE api_key = %s", (api_key,))
-        user = cur.fetchone()
-        if user:
-            return user[0]
-        return None
+        user_id = _lookup_api_key(api_key)
     except Exception as e:
-        print(f"[AUTH ERROR] API Key verification failed: {e}")
+        logger.error("API Key verification failed: %s", e)
+        return None
+
+    with _api_key_lock:
+        if user_id is not None:
+            _api_key_cache[api_key] = user_id
+        else:
+            _unknown_api_key_cache[api_key] = True
+    return user_id
+
+def invalidate_api_key(api_key):
+    """Drop a cached key, e.g. after it has been rotated or revoked."""
+    with _api_key_lock:
+        _api_key_cache.pop(api_key, None)
+        _unknown_api_key_cache.pop(api_key, None)
+
+def authenticate():
+    """Resolve the caller once per request and cache it on ``g.user_id``.
+
+    Returns None when the request may proceed, otherwise the 401/redirect
+    response to send back. Blueprints whose routes are all protected register
+    this as a ``before_request`` hook; mixed blueprints use ``login_required``.
+    """
+    req = request._get_current_object()
+    # CORS preflights carry no credentials and never reach a view
+    if req.method == 'OPTIONS':
         return None
-    finally:
-        cur.close()
+
+    # 1. Check for API Key (Bearer Token) - For ESP32/Automated Clients
+    auth_header = req.headers.get('Authorization')
+    if auth_header is not None and auth_header[:7] == 'Bearer ':
+        user_id = verify_api_key(auth_header[7:])
+        if user_id is None:
+            return jsonify({"error": "Invalid API Key"}), 401
+        g.user_id = user_id
+        return None
+
+    # 2. Check for Session Cookie - For Browser/UI
+    user_id = session.get('user_id')
+    if user_id is None:
+        # Check for AJAX/API request
+        if req.is_json or req.path[:7] == '/ingest':
+            return jsonify({"error": "Unauthorized"}), 401
+        return redirect(url_for('ui.login'))
+    g.user_id = user_id
+    return None
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # 1. Check for API Key (Bearer Token) - For ESP32/Automated Clients
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            api_key = auth_header.split(' ')[1]
-            user_id = verify_api_key(api_key)
-            if user_id:
-                # Mock session availability for the request context
-                session['user_id'] = user_id
-                return f(*args, **kwargs)
-            else:
-                 return jsonify({"error": "Invalid API Key"}), 401
-
-        # 2. Check for Session Cookie - For Browser/UI
-        if 'user_id' not in session:
-            # Check for AJAX/API request
-            if request.is_json or request.path.startswith('/ingest'):
-                return jsonify({"error": "Unauthorized"}), 401
-            return redirect(url_for('ui.login'))
+        if 'user_id' not in g:
+            denied = authenticate()
+            if denied is not None:
+                return denied
         return f(*args, **kwargs)
     return decorated_function
 
@@ -51,37 +110,38 @@ def verify_google_token(token):
     try:
         id_info = id_token.verify_oauth2_token(
             token, 
-            google_requests.Request(), 
+            _google_request, 
             GOOGLE_CLIENT_ID
         )
         return id_info
     except ValueError as e:
-        print(f"[AUTH ERROR] Token verification failed: {e}")
+        logger.warning("Token verification failed: %s", e)
         return None
 
 def get_or_create_user(google_id, email, name):
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        # Check if user exists
-        cur.execute("SELECT id FROM users WHERE google_id = %s", (google_id,))
-        user = cur.fetchone()
-        
-        if user:
-            return user[0]
-        
-        # Create new user
-        cur.execute(
-            "INSERT INTO users (google_id, email, name) VALUES (%s, %s, %s) RETURNING id",
-            (google_id, email, name)
-        )
-        new_user_id = cur.fetchone()[0]
-        conn.commit()
-        print(f"[AUTH] New user created: {email} (ID: {new_user_id})")
-        return new_user_id
-    except Exception as e:
-        conn.rollback()
-        print(f"[AUTH ERROR] DB Error: {e}")
-        return None
-    finally:
-        cur.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        try:
+            # Check if user exists
+            prepare(conn, "get_user_by_google_id_stmt", ["varchar"], "SELECT id FROM users WHERE google_id = $1")
+            cur.execute("EXECUTE get_user_by_google_id_stmt (%s)", (google_id,))
+            user = cur.fetchone()
+            
+            if user:
+                return user[0]
+            
+            # Create new user
+            cur.execute(
+                "INSERT INTO users (google_id, email, name) VALUES (%s, %s, %s) RETURNING id",
+                (google_id, email, name)
+            )
+            new_user_id = cur.fetchone()[0]
+            conn.commit()
+            logger.info("New user created: %s (ID: %s)", email, new_user_id)
+            return new_user_id
+        except Exception as e:
+            conn.rollback()
+            logger.error("DB Error: %s", e)
+            return None
+        finally:
+            cur.close()
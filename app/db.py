@@ -1,130 +1,230 @@
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 import psycopg2.extras
-import traceback
+import logging
 import os
+from contextlib import contextmanager
 
-# Global connection to maintain compatibility with original logic
-# In a production app, use a connection pool or open per-request
+logger = logging.getLogger(__name__)
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements were PREPAREd on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+# Shared connection pool: every request/worker checks a connection out for the
+# duration of its unit of work and hands it back afterwards.
 try:
-    conn = psycopg2.connect(
+    pool = psycopg2.pool.ThreadedConnectionPool(
+        minconn=int(os.getenv('DB_POOL_MIN', '4')),
+        maxconn=int(os.getenv('DB_POOL_MAX', '32')),
         host="localhost",
         database="soundml",
         user="postgres",
-        password="Debargha"
+        password="Debargha",
+        connection_factory=PooledConnection
     )
-    conn.autocommit = False 
 except Exception as e:
-    print(f"[ERROR] Database connection failed: {e}")
-    conn = None
+    logger.error("Database connection failed: %s", e)
+    pool = None
+
+@contextmanager
+def _borrow(autocommit):
+    if pool is None:
+        raise psycopg2.OperationalError("No DB connection pool available")
+
+    conn = pool.getconn()
+    conn.autocommit = autocommit
+    try:
+        yield conn
+    finally:
+        # A connection the server dropped mid-request is discarded rather than
+        # handed to the next borrower; the pool opens a fresh one on demand.
+        pool.putconn(conn, close=bool(conn.closed))
 
 def get_db():
-    """Return the global connection object"""
-    return conn
+    """Check a connection out of the pool and return it when the block exits.
+
+    Uncommitted work is rolled back by the pool on return, so a failed
+    transaction never leaks into the next borrower.
+    """
+    return _borrow(autocommit=False)
+
+def readonly_db():
+    """Like get_db(), but in autocommit mode for routes that only read.
+
+    Each statement is its own implicit transaction, so there is no
+    transaction to COMMIT/ROLLBACK when the connection goes back.
+    """
+    return _borrow(autocommit=True)
+
+def prepare(conn, name, argtypes, sql):
+    """PREPARE `sql` under `name` once per pooled connection.
+
+    Prepared statements live for the whole server session, so subsequent
+    borrowers of the same connection can EXECUTE it without re-parsing or
+    re-planning.
+
+    `argtypes` must match the column types being compared (e.g. varchar for
+    VARCHAR columns, not text) so the planner never has to cast the indexed
+    column and can always use its btree index. Plain cursor.execute() calls
+    don't need this: psycopg2 inlines parameters as untyped literals, which
+    Postgres resolves to the column's own type.
+    """
+    if name not in conn.prepared:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"PREPARE {name} ({', '.join(argtypes)}) AS {sql}")
+        finally:
+            cur.close()
+        conn.prepared.add(name)
 
 def ensure_db_schema():
     """Create required tables and indexes if they do not exist."""
-    if conn is None:
-        print("[ERROR] Cannot ensure schema: No DB connection")
+    if pool is None:
+        logger.error("Cannot ensure schema: No DB connection")
         return
 
-    cur = conn.cursor()
-    try:
-        # 1. Create USERS table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            google_id VARCHAR(255) UNIQUE NOT NULL,
-            email VARCHAR(255) NOT NULL,
-            name VARCHAR(255),
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-        # 2. Check if raw_audio has user_id, if not, we are migrating 
-        # (Strategy: TRUNCATE tables to enforce NOT NULL user_id immediately)
-        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='raw_audio' AND column_name='user_id'")
-        if not cur.fetchone():
-            print("[MIGRATION] Adding user_id to tables. TRUNCATING DATA for strict safety.")
-            # Verify tables exist before truncating to avoid errors on fresh install
-            cur.execute("SELECT to_regclass('raw_audio')")
-            if cur.fetchone()[0]:
-                cur.execute("TRUNCATE TABLE raw_audio, machine_profiles, esp32_data CASCADE")
-                
-                cur.execute("ALTER TABLE raw_audio ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL")
-                cur.execute("ALTER TABLE machine_profiles ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL")
-                cur.execute("ALTER TABLE esp32_data ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL")
-                
-                # Update Constraints for machine_profiles
-                cur.execute("ALTER TABLE machine_profiles DROP CONSTRAINT IF EXISTS machine_profiles_pkey")
-                cur.execute("ALTER TABLE machine_profiles ADD PRIMARY KEY (user_id, machine_id)")
-
-        # 3. Check for api_key in users table (Migration for ESP32 Auth)
-        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='users' AND column_name='api_key'")
-        if not cur.fetchone():
-            print("[MIGRATION] Adding api_key to users table.")
-            cur.execute("ALTER TABLE users ADD COLUMN api_key VARCHAR(64) UNIQUE")
+    with get_db() as conn:
+        cur = conn.cursor()
+        try:
+            # 1. Create USERS table
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                google_id VARCHAR(255) UNIQUE NOT NULL,
+                email VARCHAR(255) NOT NULL,
+                name VARCHAR(255),
+                created_at TIMESTAMP DEFAULT NOW()
+            );
+            """)
+
+            # 2. Legacy tables (pre user isolation) have no user_id. Migrate them in one
+            # server-side block instead of probing information_schema from the client.
+            # (Strategy: TRUNCATE tables to enforce NOT NULL user_id immediately)
+            cur.execute("""
+            DO $$
+            BEGIN
+                IF to_regclass('raw_audio') IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM pg_attribute
+                    WHERE attrelid = to_regclass('raw_audio') AND attname = 'user_id' AND NOT attisdropped
+                ) THEN
+                    RAISE NOTICE 'Adding user_id to tables. TRUNCATING DATA for strict safety.';
+                    TRUNCATE TABLE raw_audio, machine_profiles, esp32_data CASCADE;
+
+                    ALTER TABLE raw_audio ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL;
+                    ALTER TABLE machine_profiles ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL;
+                    ALTER TABLE esp32_data ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL;
+
+                    -- Update Constraints for machine_profiles
+                    ALTER TABLE machine_profiles DROP CONSTRAINT IF EXISTS machine_profiles_pkey;
+                    ALTER TABLE machine_profiles ADD PRIMARY KEY (user_id, machine_id);
+                END IF;
+            END $$;
+            """)
+
+            # 3. api_key in users table (Migration for ESP32 Auth)
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS api_key VARCHAR(64) UNIQUE")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_users_api_key ON users(api_key)")
         
-        # Ensure tables exist (for fresh install)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS raw_audio (
-            id SERIAL PRIMARY KEY,
-            timestamp TIMESTAMP NOT NULL,
-            amplitude FLOAT NOT NULL,
-            dominant_freq FLOAT,
-            freq_confidence FLOAT,
-            peaks JSONB,
-            machine_id VARCHAR(50),
-            mode VARCHAR(20) DEFAULT 'live',
-            created_at TIMESTAMP DEFAULT NOW(),
-            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL
-        );
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS machine_profiles (
-            machine_id VARCHAR(50),
-            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL,
-            median_freq FLOAT NOT NULL,
-            iqr_low FLOAT NOT NULL,
-            iqr_high FLOAT NOT NULL,
-            freq_bands JSONB,
-            vibration_data JSONB,
-            gas_data JSONB,
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW(),
-            PRIMARY KEY (user_id, machine_id)
-        );
-        """)
+            # Ensure tables exist (for fresh install)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS raw_audio (
+                id SERIAL PRIMARY KEY,
+                timestamp TIMESTAMP NOT NULL,
+                amplitude FLOAT NOT NULL,
+                dominant_freq FLOAT,
+                freq_confidence FLOAT,
+                peaks JSONB,
+                machine_id VARCHAR(50),
+                mode VARCHAR(20) DEFAULT 'live',
+                created_at TIMESTAMP DEFAULT NOW(),
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL
+            );
+            """)
+
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS machine_profiles (
+                machine_id VARCHAR(50),
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+                median_freq FLOAT NOT NULL,
+                iqr_low FLOAT NOT NULL,
+                iqr_high FLOAT NOT NULL,
+                freq_bands JSONB,
+                vibration_data JSONB,
+                gas_data JSONB,
+                created_at TIMESTAMP DEFAULT NOW(),
+                updated_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (user_id, machine_id)
+            );
+            """)
         
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS esp32_data (
-            id SERIAL PRIMARY KEY,
-            device_id VARCHAR(50),
-            timestamp TIMESTAMP DEFAULT NOW(),
-            vibration FLOAT,
-            event_count INTEGER,
-            gas_raw FLOAT,
-            gas_status VARCHAR(20),
-            created_at TIMESTAMP DEFAULT NOW(),
-            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL
-        );
-        """)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS esp32_data (
+                id SERIAL PRIMARY KEY,
+                device_id VARCHAR(50),
+                timestamp TIMESTAMP DEFAULT NOW(),
+                vibration FLOAT,
+                event_count INTEGER,
+                gas_raw FLOAT,
+                gas_status VARCHAR(20),
+                created_at TIMESTAMP DEFAULT NOW(),
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL
+            );
+            """)
         
-        # Create indexes
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_raw_audio_user_id ON raw_audio(user_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_machine_profiles_user_id ON machine_profiles(user_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_esp32_data_user_id ON esp32_data(user_id);")
+            # Background job results (Gemini analyses, profile builds). Kept in the
+            # database so any worker process can answer a poll for any job.
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS background_jobs (
+                id VARCHAR(32) PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+                kind VARCHAR(32) NOT NULL,
+                http_status INTEGER,
+                result JSONB,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP
+            );
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_background_jobs_created ON background_jobs(created_at);")
+
+            # Create indexes
+            # Per-user time-series scans ("WHERE user_id = ? ORDER BY timestamp DESC LIMIT n",
+            # range aggregations) are served by one composite index range scan.
+            # On a large live database, build these by hand with CREATE INDEX CONCURRENTLY
+            # first (it cannot run inside this transaction); IF NOT EXISTS then skips them.
+            # The INCLUDE columns are everything the session aggregator reads, so its
+            # range scans are index-only and never touch the heap.
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_raw_audio_user_ts_cov ON raw_audio(user_id, timestamp DESC)
+            INCLUDE (dominant_freq, freq_confidence, machine_id, mode);
+            """)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_esp32_data_user_ts_cov ON esp32_data(user_id, timestamp DESC)
+            INCLUDE (vibration, gas_raw, device_id, gas_status);
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_raw_audio_user_machine_ts ON raw_audio(user_id, machine_id, timestamp DESC);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_machine_profiles_user_id ON machine_profiles(user_id);")
         
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_esp32_data_device_id ON esp32_data(device_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_esp32_data_timestamp ON esp32_data(timestamp);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_raw_audio_timestamp ON raw_audio(timestamp);")
-
-        conn.commit()
-        print("[OK] Database schema ensured with USER ISOLATION")
-    except Exception as e:
-        conn.rollback()
-        print("[ERROR] Error ensuring DB schema:", str(e))
-        traceback.print_exc()
-    finally:
-        cur.close()
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_esp32_data_device_id ON esp32_data(device_id);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_esp32_data_timestamp ON esp32_data(timestamp);")
+
+            # Superseded by the composite indexes above (left-anchored on user_id)
+            cur.execute("DROP INDEX IF EXISTS idx_raw_audio_user_id;")
+            cur.execute("DROP INDEX IF EXISTS idx_esp32_data_user_id;")
+            cur.execute("DROP INDEX IF EXISTS idx_raw_audio_timestamp;")
+            # Superseded by the covering variants (same key, plus INCLUDE columns)
+            cur.execute("DROP INDEX IF EXISTS idx_raw_audio_user_ts;")
+            cur.execute("DROP INDEX IF EXISTS idx_esp32_data_user_ts;")
+
+            # All DDL above runs in one transaction: it either all applies or rolls back
+            conn.commit()
+            logger.info("Database schema ensured with USER ISOLATION")
+        except Exception as e:
+            conn.rollback()
+            logger.exception("Error ensuring DB schema: %s", e)
+        finally:
+            cur.close()
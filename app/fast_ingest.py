@@ -0,0 +1,46 @@
+import orjson
+from app.auth import verify_api_key
+from app.services.batch_processor import accept_batch
+
+_JSON_HEADERS = [("Content-Type", "application/json")]
+_STATUS_LINES = {202: "202 ACCEPTED", 400: "400 BAD REQUEST", 401: "401 UNAUTHORIZED", 503: "503 SERVICE UNAVAILABLE"}
+
+
+class IngestBatchFastPath:
+    """WSGI middleware that answers device POSTs to /ingest_batch without entering Flask.
+
+    The endpoint only validates an API key and queues the raw body, so routing,
+    the request context, sessions and the JSON provider are pure overhead for
+    ESP32 clients. Only Bearer-authenticated, non-CORS requests with a known
+    Content-Length take this path; everything else falls through to the
+    Flask route, which behaves identically.
+    """
+
+    def __init__(self, app, path="/ingest_batch"):
+        self.app = app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if (environ.get("PATH_INFO") != self.path
+                or environ.get("REQUEST_METHOD") != "POST"
+                or "HTTP_ORIGIN" in environ):
+            return self.app(environ, start_response)
+
+        auth_header = environ.get("HTTP_AUTHORIZATION", "")
+        content_length = environ.get("CONTENT_LENGTH")
+        if auth_header[:7] != "Bearer " or not content_length:
+            return self.app(environ, start_response)
+
+        user_id = verify_api_key(auth_header[7:])
+        if user_id is None:
+            body, status = {"error": "Invalid API Key"}, 401
+        else:
+            try:
+                raw = environ["wsgi.input"].read(int(content_length))
+            except ValueError:
+                return self.app(environ, start_response)
+            body, status = accept_batch(user_id, raw)
+
+        payload = orjson.dumps(body)
+        start_response(_STATUS_LINES[status], _JSON_HEADERS + [("Content-Length", str(len(payload)))])
+        return [payload]
@@ -1,8 +1,12 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, g, Response, request, jsonify, current_app, abort
 import sys
 import os
-import traceback
-from app.auth import login_required
+import logging
+from datetime import datetime
+from app.auth import authenticate
+from app.services.jobs import BackgroundJobs
+
+logger = logging.getLogger(__name__)
 
 # Ensure we can import from scripts
 # sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
@@ -12,7 +16,7 @@ from app.auth import login_required
 try:
     from app.scripts.session_aggregator import aggregate_session_data, get_gemini_api_key_status, call_gemini_with_fallback, get_latest_data_range, validate_time_range
 except ImportError as e:
-    print(f"[WARN] Could not import session_aggregator: {e}")
+    logger.warning("Could not import session_aggregator: %s", e)
     # Mocking for robust startup if script is missing
     def aggregate_session_data(*args, **kwargs): raise NotImplementedError("session_aggregator missing")
     def get_gemini_api_key_status(): return {"configured": False, "error": "Module missing"}
@@ -20,116 +24,163 @@ except ImportError as e:
     def get_latest_data_range(*args, **kwargs): return {"has_data": False, "error": "Module missing"}
     def validate_time_range(*args): return {"valid": False, "error": "Module missing"}
 
-from app.db import get_db
+from app.db import get_db, readonly_db
 
 gemini_bp = Blueprint('gemini', __name__)
+# Every route here is protected, so resolve the caller once per request
+gemini_bp.before_request(authenticate)
+
+# Gemini calls run here so request threads are released immediately; the job
+# state lives in the database, so any worker process can answer the poll.
+GEMINI_JOBS = BackgroundJobs(
+    "gemini_analysis",
+    max_workers=8,
+    max_backlog=int(os.getenv('GEMINI_MAX_BACKLOG', '32'))
+)
 
 @gemini_bp.route("/latest-data-range", methods=["GET"])
-@login_required
 def latest_data_range_route():
     try:
         duration = request.args.get('duration', default=60, type=int)
-        conn = get_db()
-        user_id = session['user_id']
-        result = get_latest_data_range(conn, user_id=user_id, duration_seconds=duration)
+        user_id = g.user_id
+        with readonly_db() as conn:
+            result = get_latest_data_range(conn, user_id=user_id, duration_seconds=duration)
         return jsonify(result)
     except Exception as e:
-        print(f"[ERROR] LATEST_DATA_RANGE ERROR: {str(e)}")
+        logger.error("LATEST_DATA_RANGE ERROR: %s", e)
         return jsonify({"error": str(e), "has_data": False}), 500
 
 @gemini_bp.route("/validate-time-range", methods=["GET"])
-@login_required
 def validate_range():
     start_ts = request.args.get('start')
     stop_ts = request.args.get('stop')
-    user_id = session['user_id']
+    user_id = g.user_id
     if not start_ts or not stop_ts:
         return jsonify({"error": "start and stop are required", "valid": False}), 400
     try:
-        conn = get_db()
-        result = validate_time_range(conn, user_id, start_ts, stop_ts)
+        with readonly_db() as conn:
+            result = validate_time_range(conn, user_id, start_ts, stop_ts)
         return jsonify(result)
     except Exception as e:
-        print(f"[ERROR] VALIDATE_TIME_RANGE ERROR: {str(e)}")
+        logger.error("VALIDATE_TIME_RANGE ERROR: %s", e)
         return jsonify({"error": str(e), "valid": False}), 500
 
 @gemini_bp.route("/session-preview", methods=["GET"])
-@login_required
 def get_session_preview():
     start_ts = request.args.get('start')
     stop_ts = request.args.get('stop')
     machine_id = request.args.get('machine_id')
     device_id = request.args.get('device_id')
-    user_id = session['user_id']
-
-    if start_ts: start_ts = start_ts.replace('%3A', ':')
-    if stop_ts: stop_ts = stop_ts.replace('%3A', ':')
+    user_id = g.user_id
 
     if not start_ts or not stop_ts:
         return jsonify({"error": "start and stop timestamps are required"}), 400
+
+    # Reject malformed timestamps before borrowing a DB connection
+    try:
+        datetime.fromisoformat(start_ts.replace('Z', '+00:00'))
+        datetime.fromisoformat(stop_ts.replace('Z', '+00:00'))
+    except ValueError:
+        return jsonify({"error": "start and stop must be ISO-8601 timestamps"}), 400
     
     try:
-        conn = get_db()
-        payload = aggregate_session_data(
-            conn=conn,
-            user_id=user_id,
-            start_ts=start_ts,
-            stop_ts=stop_ts,
-            machine_id=machine_id or None,
-            device_id=device_id or None
-        )
-        print(f"[OK] SESSION PREVIEW: {start_ts} to {stop_ts}")
+        # Transactional checkout: the aggregation streams rows through
+        # server-side cursors, which only exist inside a transaction
+        with get_db() as conn:
+            payload = aggregate_session_data(
+                conn=conn,
+                user_id=user_id,
+                start_ts=start_ts,
+                stop_ts=stop_ts,
+                machine_id=machine_id or None,
+                device_id=device_id or None
+            )
+        logger.info("SESSION PREVIEW: %s to %s", start_ts, stop_ts)
         return jsonify(payload)
     except Exception as e:
-        print(f"[ERROR] SESSION_PREVIEW ERROR: {str(e)}")
-        traceback.print_exc()
+        logger.exception("SESSION_PREVIEW ERROR: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @gemini_bp.route("/api-key-status", methods=["GET"])
-@login_required
 def api_key_status():
     status = get_gemini_api_key_status()
     return jsonify(status)
 
 @gemini_bp.route("/debug-db", methods=["GET"])
-@login_required
 def debug_db():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
-    try:
-        result = {}
-        cursor.execute("SELECT COUNT(*) FROM raw_audio WHERE user_id = %s", (user_id,))
-        result['raw_audio_count'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT MIN(timestamp), MAX(timestamp) FROM raw_audio WHERE user_id = %s", (user_id,))
-        row = cursor.fetchone()
-        result['raw_audio_earliest'] = str(row[0]) if row[0] else None
-        result['raw_audio_latest'] = str(row[1]) if row[1] else None
-        
-        cursor.execute("SELECT COUNT(*) FROM esp32_data")
-        result['esp32_data_count'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT MIN(timestamp), MAX(timestamp) FROM esp32_data")
-        row = cursor.fetchone()
-        result['esp32_earliest'] = str(row[0]) if row[0] else None
-        result['esp32_latest'] = str(row[1]) if row[1] else None
-        
-        cursor.execute("SELECT COUNT(*) FROM machine_profiles WHERE user_id = %s", (user_id,))
-        result['profiles_count'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT timestamp, amplitude, dominant_freq, machine_id, mode FROM raw_audio WHERE user_id = %s ORDER BY timestamp DESC LIMIT 5", (user_id,))
-        result['recent_raw_audio'] = [{'timestamp': str(r[0]), 'amplitude': r[1], 'dominant_freq': r[2], 'machine_id': r[3], 'mode': r[4]} for r in cursor.fetchall()]
-        
-        cursor.execute("SELECT timestamp, device_id, vibration, gas_raw, gas_status FROM esp32_data ORDER BY timestamp DESC LIMIT 5")
-        result['recent_esp32_data'] = [{'timestamp': str(r[0]), 'device_id': r[1], 'vibration': r[2], 'gas_raw': r[3], 'gas_status': r[4]} for r in cursor.fetchall()]
-        
-        return jsonify(result)
-    except Exception as e:
-        print(f"[ERROR] DEBUG_DB ERROR: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        cursor.close()
+    # Diagnostic route: a per-user data dump is not something to serve in production
+    if not current_app.debug:
+        abort(404)
+
+    user_id = g.user_id
+    with readonly_db() as conn:
+        cursor = conn.cursor()
+        try:
+            # Single round-trip: Postgres builds the whole response document, so
+            # the JSON text is passed straight through without a Python row loop
+            cursor.execute("""
+                WITH ra AS (
+                    -- Presence and bounds only: each probe stops at its first
+                    -- entry in the (user_id, timestamp) index
+                    SELECT
+                        EXISTS (SELECT 1 FROM raw_audio WHERE user_id = %(user_id)s) AS present,
+                        (SELECT timestamp FROM raw_audio WHERE user_id = %(user_id)s
+                         ORDER BY timestamp ASC LIMIT 1) AS mn,
+                        (SELECT timestamp FROM raw_audio WHERE user_id = %(user_id)s
+                         ORDER BY timestamp DESC LIMIT 1) AS mx
+                ),
+                ed AS (
+                    SELECT
+                        EXISTS (SELECT 1 FROM esp32_data WHERE user_id = %(user_id)s) AS present,
+                        (SELECT timestamp FROM esp32_data WHERE user_id = %(user_id)s
+                         ORDER BY timestamp ASC LIMIT 1) AS mn,
+                        (SELECT timestamp FROM esp32_data WHERE user_id = %(user_id)s
+                         ORDER BY timestamp DESC LIMIT 1) AS mx
+                ),
+                mp AS (
+                    SELECT COUNT(*) AS c FROM machine_profiles WHERE user_id = %(user_id)s
+                ),
+                ra_recent AS (
+                    SELECT json_agg(json_build_object(
+                        'timestamp', timestamp, 'amplitude', amplitude, 'dominant_freq', dominant_freq,
+                        'machine_id', machine_id, 'mode', mode
+                    ) ORDER BY timestamp DESC) AS j FROM (
+                        SELECT timestamp, amplitude, dominant_freq, machine_id, mode
+                        FROM raw_audio WHERE user_id = %(user_id)s
+                        ORDER BY timestamp DESC LIMIT 5
+                    ) s
+                ),
+                ed_recent AS (
+                    SELECT json_agg(json_build_object(
+                        'timestamp', timestamp, 'device_id', device_id, 'vibration', vibration,
+                        'gas_raw', gas_raw, 'gas_status', gas_status
+                    ) ORDER BY timestamp DESC) AS j FROM (
+                        SELECT timestamp, device_id, vibration, gas_raw, gas_status
+                        FROM esp32_data WHERE user_id = %(user_id)s
+                        ORDER BY timestamp DESC LIMIT 5
+                    ) s
+                )
+                SELECT json_build_object(
+                    'has_raw_audio', ra.present,
+                    'raw_audio_earliest', ra.mn::text,
+                    'raw_audio_latest', ra.mx::text,
+                    'has_esp32_data', ed.present,
+                    'esp32_earliest', ed.mn::text,
+                    'esp32_latest', ed.mx::text,
+                    'profiles_count', mp.c,
+                    'recent_raw_audio', COALESCE(ra_recent.j, '[]'::json),
+                    'recent_esp32_data', COALESCE(ed_recent.j, '[]'::json)
+                )::text
+                FROM ra, ed, mp, ra_recent, ed_recent
+            """, {'user_id': user_id})
+            result = cursor.fetchone()[0]
+            
+            return Response(result, mimetype='application/json')
+        except Exception as e:
+            logger.error("DEBUG_DB ERROR: %s", e)
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
 
 def generate_rule_based_analysis(session_data: dict) -> dict:
     findings = []
@@ -144,22 +195,49 @@ def generate_rule_based_analysis(session_data: dict) -> dict:
         
     return {"health_status": "NORMAL" if out_of_profile < 50 else "WARNING", "findings": findings, "recommendations": ["Monitor machine closely"] if out_of_profile > 10 else []}
 
+def run_gemini_analysis(session_data: dict) -> dict:
+    """Call Gemini (or fall back to rules) and build the /gemini-analyze response body."""
+    logger.info("GEMINI ANALYZE: Sending session to Gemini API...")
+    try:
+        result = call_gemini_with_fallback(session_data)
+        return {"status": "success", "ai_used": True, "model": result["model_used"], "analysis": result["analysis"]}
+    except RuntimeError as e:
+        logger.warning("GEMINI FALLBACK: %s", e)
+        return {"status": "fallback", "ai_used": False, "reason": str(e), "fallback": "Rule-based diagnostics only", "analysis": generate_rule_based_analysis(session_data)}
+
 @gemini_bp.route("/gemini-analyze", methods=["POST"])
-@login_required
 def gemini_analyze():
+    """Queue a Gemini analysis and return a job id to poll.
+    The external API call can take seconds, so it never runs on the request thread.
+    """
     try:
         data = request.get_json(force=True)
         session_data = data.get('session_data')
         if not session_data: return jsonify({"error": "session_data is required"}), 400
-        
-        print(f"[OK] GEMINI ANALYZE: Sending session to Gemini API...")
-        try:
-            result = call_gemini_with_fallback(session_data)
-            return jsonify({"status": "success", "ai_used": True, "model": result["model_used"], "analysis": result["analysis"]})
-        except RuntimeError as e:
-            print(f"[WARN] GEMINI FALLBACK: {str(e)}")
-            return jsonify({"status": "fallback", "ai_used": False, "reason": str(e), "fallback": "Rule-based diagnostics only", "analysis": generate_rule_based_analysis(session_data)})
+
+        job_id = GEMINI_JOBS.submit(g.user_id, _analysis_job, session_data)
+        if job_id is None:
+            return jsonify({"error": "Too many analyses in progress, try again shortly"}), 503
+        return jsonify({"status": "pending", "job_id": job_id}), 202
     except Exception as e:
-        print(f"[ERROR] GEMINI_ANALYZE ERROR: {str(e)}")
-        traceback.print_exc()
+        logger.exception("GEMINI_ANALYZE ERROR: %s", e)
         return jsonify({"error": str(e)}), 500
+
+def _analysis_job(session_data):
+    return run_gemini_analysis(session_data), 200
+
+@gemini_bp.route("/gemini-analyze/<job_id>", methods=["GET"])
+def gemini_analyze_result(job_id):
+    try:
+        job = GEMINI_JOBS.result(job_id, g.user_id)
+    except Exception as e:
+        logger.error("GEMINI_ANALYZE ERROR: %s", e)
+        return jsonify({"error": str(e)}), 500
+    if job is None:
+        return jsonify({"error": "Unknown analysis job"}), 404
+
+    status, body = job
+    if status is None:
+        return jsonify({"status": "pending", "job_id": job_id}), 202
+    # Stored as JSON text already; pass it straight through
+    return Response(body, status=status, mimetype='application/json')
@@ -1,303 +1,318 @@
-from flask import Blueprint, request, jsonify, session
-import queue
-import traceback
+from flask import Blueprint, g, request, jsonify
+from threading import Lock
+from cachetools import TTLCache
+import logging
 from datetime import datetime
+import operator
+import orjson
 import psycopg2.extras
-from app.db import get_db
-from app.services.batch_processor import BATCH_QUEUE, persist_failed_batch
-from app.services.audio_processing import AMPLITUDE_THRESHOLD, noise_model, identify_machines
+from app.db import get_db, readonly_db, prepare
+from app.services.batch_processor import accept_batch
+from app.services.raw_audio_writer import insert_raw_audio
+from app.services.audio_processing import audible_frame_indices, noise_model, identify_machines_batch, get_all_machines
+from app.services.esp32_writer import GROUP_COMMIT_ENABLED, submit_reading
 from app.services.stability import update_detection_history, get_stable_machines
-from app.auth import login_required
+from app.auth import authenticate
+
+logger = logging.getLogger(__name__)
 
 ingest_bp = Blueprint('ingest', __name__)
+# Every route here is protected, so resolve the caller once per request
+ingest_bp.before_request(authenticate)
+
+# Frames from the ESP32 firmware always carry these keys; one C-level call
+# unpacks them, with dict.get() as the fallback for partial frames
+_frame_fields = operator.itemgetter("amplitude", "peaks", "timestamp")
+_peak_fields = operator.itemgetter("freq", "amp")
+
+# Dashboards poll /latest_esp32 several times a second; sensors report at
+# most ~10 Hz, so a reading younger than 200 ms is served from memory.
+_latest_esp32_cache = TTLCache(maxsize=1024, ttl=0.2)
+_latest_esp32_lock = Lock()
 
 @ingest_bp.route("/ingest_batch", methods=["POST"])
-@login_required
 def ingest_batch():
     """Accept large batch payloads and enqueue for background processing.
     Returns 202 Accepted immediately so upstream proxies (nginx) won't timeout.
     """
-    try:
-        payload = request.get_json(force=True)
-    except Exception as e:
-        print('[ERROR] ingest_batch: invalid JSON', str(e))
-        return jsonify({"error": "invalid json"}), 400
-
-    if not payload or 'frames' not in payload:
-        return jsonify({"error": "frames required"}), 400
-
-    # Inject user_id from session for the worker
-    payload['user_id'] = session['user_id']
-
-    try:
-        BATCH_QUEUE.put_nowait(payload)
-        qsize = BATCH_QUEUE.qsize()
-        return jsonify({
-            "status": "accepted",
-            "queue_size": qsize
-        }), 202
-    except queue.Full:
-        persist_failed_batch(payload)
-        return jsonify({"error": "queue full, persisted"}), 503
+    body, status = accept_batch(g.user_id, request.get_data(cache=False))
+    return jsonify(body), status
 
 
 @ingest_bp.route("/ingest", methods=["POST"])
-@login_required
 def ingest():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
+    user_id = g.user_id
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    try:
-        data = request.get_json(force=True)
-        mode = data.get("mode", "live")
-        store_all = data.get("store_all", False)
-
-        if mode == "calibration":
-            frames = data.get("frames", [])
-            machine_id = data.get("machine_id")
-            frames_captured = data.get("frames_captured", len(frames))
-
-            if not frames or not machine_id:
-                return jsonify({"error": "frames and machine_id required"}), 400
-
-            inserted_count = 0
-            for frame in frames:
-                amplitude = frame.get("amplitude")
-                peaks = frame.get("peaks", [])
-                timestamp = frame.get("timestamp")
-
-                if not store_all and (amplitude < AMPLITUDE_THRESHOLD or len(peaks) == 0):
-                    continue
-
-                if len(peaks) > 0:
-                    dominant_freq = peaks[0].get("freq")
-                    freq_confidence = peaks[0].get("amp")
-                else:
-                    dominant_freq = None
-                    freq_confidence = None
-
-                ts = datetime.fromtimestamp(timestamp / 1000) if timestamp else datetime.now()
-
-                cursor.execute(
-                    """
-                    INSERT INTO raw_audio
-                    (timestamp, amplitude, dominant_freq, freq_confidence, peaks, machine_id, mode, user_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
+        try:
+            data = request.get_json(force=True)
+            mode = data.get("mode", "live")
+            store_all = data.get("store_all", False)
+
+            if mode == "calibration":
+                frames = data.get("frames", [])
+                machine_id = data.get("machine_id")
+                frames_captured = data.get("frames_captured", len(frames))
+
+                if not frames or not machine_id:
+                    return jsonify({"error": "frames and machine_id required"}), 400
+
+                rows = []
+                kept = range(len(frames)) if store_all else audible_frame_indices(frames)
+                for i in kept:
+                    frame = frames[i]
+                    try:
+                        amplitude, peaks, timestamp = _frame_fields(frame)
+                    except KeyError:
+                        amplitude, peaks, timestamp = frame.get("amplitude"), frame.get("peaks", []), frame.get("timestamp")
+
+                    if len(peaks) > 0:
+                        try:
+                            dominant_freq, freq_confidence = _peak_fields(peaks[0])
+                        except KeyError:
+                            dominant_freq, freq_confidence = peaks[0].get("freq"), peaks[0].get("amp")
+                    else:
+                        dominant_freq = None
+                        freq_confidence = None
+
+                    ts = timestamp / 1000 if timestamp else None
+
+                    rows.append((
                         ts,
                         amplitude,
                         dominant_freq,
                         freq_confidence,
-                        psycopg2.extras.Json(peaks),
+                        orjson.dumps(peaks).decode(),
                         machine_id,
                         mode,
                         user_id
-                    )
-                )
-                inserted_count += 1
-
-            conn.commit()
-            print(f"\n[OK] CALIBRATION BATCH: {machine_id} - Frames: {len(frames)}, Inserted: {inserted_count}")
-
-            return jsonify({
-                "status": "calibration_batch_saved",
-                "frames_received": len(frames),
-                "frames_captured": frames_captured,
-                "frames_inserted": inserted_count,
-                "machine_id": machine_id
-            })
-
-        elif mode == "live":
-            frames = data.get("frames", [])
-            frames_captured = data.get("frames_captured", len(frames))
-
-            if not frames:
-                return jsonify({"error": "frames required"}), 400
-
-            running_machines = set()
-            anomaly_machines = set()
-            inserted_count = 0
-
-            for frame in frames:
-                amplitude = frame.get("amplitude")
-                peaks = frame.get("peaks", [])
-                timestamp = frame.get("timestamp")
-
-                if not store_all and (amplitude < AMPLITUDE_THRESHOLD or len(peaks) == 0):
-                    continue
-
-                z_score, anomaly = noise_model.update(amplitude)
-
-                if len(peaks) > 0:
-                    dominant_freq = peaks[0].get("freq")
-                    freq_confidence = peaks[0].get("amp")
-                else:
-                    dominant_freq = None
-                    freq_confidence = None
-
-                ts = datetime.fromtimestamp(timestamp / 1000) if timestamp else datetime.now()
-
-                cursor.execute(
-                    """
-                    INSERT INTO raw_audio
-                    (timestamp, amplitude, dominant_freq, freq_confidence, peaks, machine_id, mode, user_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
+                    ))
+
+                inserted_count = len(rows)
+                if rows:
+                    insert_raw_audio(cursor, rows)
+                conn.commit()
+                logger.info("CALIBRATION BATCH: %s - Frames: %d, Inserted: %d", machine_id, len(frames), inserted_count)
+
+                return jsonify({
+                    "status": "calibration_batch_saved",
+                    "frames_received": len(frames),
+                    "frames_captured": frames_captured,
+                    "frames_inserted": inserted_count,
+                    "machine_id": machine_id
+                })
+
+            elif mode == "live":
+                frames = data.get("frames", [])
+                frames_captured = data.get("frames_captured", len(frames))
+
+                if not frames:
+                    return jsonify({"error": "frames required"}), 400
+
+                rows = []
+                all_peaks = []
+                live_amps = []
+
+                kept = range(len(frames)) if store_all else audible_frame_indices(frames)
+                for i in kept:
+                    frame = frames[i]
+                    try:
+                        amplitude, peaks, timestamp = _frame_fields(frame)
+                    except KeyError:
+                        amplitude, peaks, timestamp = frame.get("amplitude"), frame.get("peaks", []), frame.get("timestamp")
+
+                    live_amps.append(amplitude)
+
+                    if len(peaks) > 0:
+                        try:
+                            dominant_freq, freq_confidence = _peak_fields(peaks[0])
+                        except KeyError:
+                            dominant_freq, freq_confidence = peaks[0].get("freq"), peaks[0].get("amp")
+                    else:
+                        dominant_freq = None
+                        freq_confidence = None
+
+                    ts = timestamp / 1000 if timestamp else None
+
+                    rows.append((
                         ts,
                         amplitude,
                         dominant_freq,
                         freq_confidence,
-                        psycopg2.extras.Json(peaks),
+                        orjson.dumps(peaks).decode(),
                         None,
                         mode,
                         user_id
-                    )
-                )
-                inserted_count += 1
+                    ))
 
-                if len(peaks) > 0:
-                    result = identify_machines(user_id, peaks)
-                    running_machines.update(result["detected"])
-                    anomaly_machines.update(result["anomaly"])
+                    if len(peaks) > 0:
+                        all_peaks.append(peaks)
 
-            conn.commit()
+                noise_model.update_batch(live_amps)
 
-            cursor.execute("SELECT machine_id FROM machine_profiles WHERE user_id = %s", (user_id,))
-            all_machines = [row[0] for row in cursor.fetchall()]
+                inserted_count = len(rows)
+                if rows:
+                    insert_raw_audio(cursor, rows)
+                conn.commit()
+
+                result = identify_machines_batch(user_id, all_peaks)
+                running_machines = set(result["detected"])
+                anomaly_machines = set(result["anomaly"])
+                all_machines = get_all_machines(user_id)
             
-            update_detection_history(user_id, running_machines, all_machines)
-            stable_machines = get_stable_machines(user_id, all_machines)
-
-            skipped_count = len(frames) - inserted_count
-            print(f"\n[OK] LIVE BATCH: {len(frames)} frames, {inserted_count} inserted ({skipped_count} skipped: low amp/no peaks)")
-            print(f"   Detected (raw): {sorted(running_machines)}")
-            print(f"   Stable machines: {sorted(stable_machines)}")
-
-            return jsonify({
-                "status": "ok",
-                "frames_received": len(frames),
-                "frames_captured": frames_captured,
-                "frames_inserted": inserted_count,
-                "running_machines": sorted(stable_machines),
-                "running_machines_raw": sorted(running_machines),
-                "anomaly_machines": sorted(anomaly_machines),
-                "all_machines": all_machines
-            })
-
-        else:
-            return jsonify({"error": "invalid mode"}), 400
-
-    except Exception as e:
-        conn.rollback()
-        print("[ERROR] INGEST ERROR:", str(e))
-        return jsonify({"error": "server error"}), 500
-
-    finally:
-        cursor.close()
+                update_detection_history(user_id, running_machines, all_machines)
+                stable_machines = get_stable_machines(user_id, all_machines)
+
+                if logger.isEnabledFor(logging.INFO):
+                    skipped_count = len(frames) - inserted_count
+                    logger.info(
+                        "LIVE BATCH: %d frames, %d inserted (%d skipped: low amp/no peaks); detected (raw): %s; stable: %s",
+                        len(frames), inserted_count, skipped_count, sorted(running_machines), sorted(stable_machines)
+                    )
+
+                return jsonify({
+                    "status": "ok",
+                    "frames_received": len(frames),
+                    "frames_captured": frames_captured,
+                    "frames_inserted": inserted_count,
+                    "running_machines": sorted(stable_machines),
+                    "running_machines_raw": sorted(running_machines),
+                    "anomaly_machines": sorted(anomaly_machines),
+                    "all_machines": all_machines
+                })
+
+            else:
+                return jsonify({"error": "invalid mode"}), 400
+
+        except Exception as e:
+            conn.rollback()
+            logger.error("INGEST ERROR: %s", e)
+            return jsonify({"error": "server error"}), 500
+
+        finally:
+            cursor.close()
 
 # ESP32 Routes defined in same file for logical grouping
 @ingest_bp.route("/ingest_esp32", methods=["POST"])
-@login_required
 def ingest_esp32():
     """Dedicated endpoint for ESP32 sensor data"""
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
-    
-    try:
-        data = request.get_json(force=True)
-        device_id   = data.get("device_id")
-        vibration   = data.get("vibration")
-        event_count = data.get("event_count")
-        gas_raw     = data.get("gas_raw")
-        gas_status  = data.get("gas_status")
-        
-        if not device_id:
-            return jsonify({"error": "device_id required"}), 400
-        
-        cursor.execute(
-            """
-            INSERT INTO esp32_data
-            (device_id, timestamp, vibration, event_count, gas_raw, gas_status, user_id)
-            VALUES (%s, NOW(), %s, %s, %s, %s, %s)
-            """,
-            (device_id, vibration, event_count, gas_raw, gas_status, user_id)
-        )
-        conn.commit()
-        print(f"[OK] ESP32 STORED: device={device_id}, vibration={vibration}")
+    user_id = g.user_id
+    # Stamped on arrival, the same way for the direct and the group-commit path
+    received_at = datetime.now()
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON object required"}), 400
+
+    device_id   = data.get("device_id")
+    vibration   = data.get("vibration")
+    event_count = data.get("event_count")
+    gas_raw     = data.get("gas_raw")
+    gas_status  = data.get("gas_status")
+
+    if not device_id:
+        return jsonify({"error": "device_id required"}), 400
+
+    # Group commit hands the reading to the flusher without borrowing a connection
+    if GROUP_COMMIT_ENABLED:
+        submit_reading(device_id, received_at, vibration, event_count, gas_raw, gas_status, user_id)
         return jsonify({"status": "stored"}), 200
+
+    with get_db() as conn:
+        cursor = conn.cursor()
+    
+        try:
+            prepare(
+                conn, "esp32_insert_stmt",
+                ["varchar", "timestamp", "float8", "int4", "float8", "varchar", "int4"],
+                """
+                INSERT INTO esp32_data
+                (device_id, timestamp, vibration, event_count, gas_raw, gas_status, user_id)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                """
+            )
+            cursor.execute(
+                "EXECUTE esp32_insert_stmt (%s, %s, %s, %s, %s, %s, %s)",
+                (device_id, received_at, vibration, event_count, gas_raw, gas_status, user_id)
+            )
+            conn.commit()
+            logger.debug("ESP32 STORED: device=%s, vibration=%s", device_id, vibration)
+            return jsonify({"status": "stored"}), 200
         
-    except Exception as e:
-        conn.rollback()
-        print(f"[ERROR] ESP32 INGEST ERROR: {str(e)}")
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        cursor.close()
+        except Exception as e:
+            conn.rollback()
+            logger.exception("ESP32 INGEST ERROR: %s", e)
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
 
 
 @ingest_bp.route("/latest_esp32", methods=["GET"])
-@login_required
 def latest_esp32():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
-    try:
-        cursor.execute(
-            """
-            SELECT device_id, vibration, event_count, gas_raw, gas_status, timestamp
-            FROM esp32_data
-            ORDER BY timestamp DESC
-            LIMIT 1
-            """
-        )
-        row = cursor.fetchone()
-        if row:
-            return jsonify({
-                "device_id": row[0],
-                "vibration": row[1],
-                "event_count": row[2],
-                "gas_raw": row[3],
-                "gas_status": row[4],
-                "timestamp": str(row[5]) if row[5] else None
-            })
-        else:
-            return jsonify({
-                "device_id": None,
-                "vibration": 0,
-                "event_count": 0,
-                "gas_raw": 0,
-                "gas_status": "UNKNOWN"
-            })
-    except Exception as e:
-        print(f"[ERROR] LATEST_ESP32 ERROR: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        cursor.close()
+    user_id = g.user_id
+    with _latest_esp32_lock:
+        cached = _latest_esp32_cache.get(user_id)
+    if cached is not None:
+        return jsonify(cached)
+
+    with readonly_db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT device_id, vibration, event_count, gas_raw, gas_status, timestamp
+                FROM esp32_data
+                WHERE user_id = %s
+                ORDER BY timestamp DESC
+                LIMIT 1
+                """,
+                (user_id,)
+            )
+            row = cursor.fetchone()
+            if row:
+                latest = {
+                    "device_id": row[0],
+                    "vibration": row[1],
+                    "event_count": row[2],
+                    "gas_raw": row[3],
+                    "gas_status": row[4],
+                    "timestamp": str(row[5]) if row[5] else None
+                }
+            else:
+                latest = {
+                    "device_id": None,
+                    "vibration": 0,
+                    "event_count": 0,
+                    "gas_raw": 0,
+                    "gas_status": "UNKNOWN"
+                }
+            with _latest_esp32_lock:
+                _latest_esp32_cache[user_id] = latest
+            return jsonify(latest)
+        except Exception as e:
+            logger.error("LATEST_ESP32 ERROR: %s", e)
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
 
 @ingest_bp.route("/esp32_data", methods=["GET"])
-@login_required
 def get_esp32_data():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
-    try:
-        limit = request.args.get("limit", default=100, type=int)
-        device_id = request.args.get("device_id", default=None, type=str)
+    user_id = g.user_id
+    with readonly_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            limit = request.args.get("limit", default=100, type=int)
+            device_id = request.args.get("device_id", default=None, type=str)
         
-        if device_id:
-            cursor.execute("SELECT id, device_id, timestamp, vibration, event_count, gas_raw, gas_status FROM esp32_data WHERE device_id = %s AND user_id = %s ORDER BY timestamp DESC LIMIT %s", (device_id, user_id, limit))
-        else:
-            cursor.execute("SELECT id, device_id, timestamp, vibration, event_count, gas_raw, gas_status FROM esp32_data WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s", (user_id, limit,))
+            if device_id:
+                cursor.execute("SELECT id, device_id, timestamp::text AS timestamp, vibration, event_count, gas_raw, gas_status FROM esp32_data WHERE device_id = %s AND user_id = %s ORDER BY timestamp DESC LIMIT %s", (device_id, user_id, limit))
+            else:
+                cursor.execute("SELECT id, device_id, timestamp::text AS timestamp, vibration, event_count, gas_raw, gas_status FROM esp32_data WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s", (user_id, limit,))
         
-        rows = cursor.fetchall()
-        data = [{"id": r[0], "device_id": r[1], "timestamp": str(r[2]), "vibration": r[3], "event_count": r[4], "gas_raw": r[5], "gas_status": r[6]} for r in rows]
-        return jsonify(data)
-    except Exception as e:
-        print(f"[ERROR] ESP32 GET ERROR: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        cursor.close()
+            # RealDictCursor rows serialize as-is
+            return jsonify(cursor.fetchall())
+        except Exception as e:
+            logger.error("ESP32 GET ERROR: %s", e)
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
@@ -1,219 +1,282 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, g, Response, request, jsonify
+import heapq
+import logging
+import numpy as np
+import os
 import psycopg2.extras
-import traceback
+from array import array
+from threading import Lock
+from cachetools import TTLCache
 from app.db import get_db
-from app.services.stability import get_stable_machines, detection_history
+from app.services.audio_processing import invalidate_profiles, get_all_machines
+from app.services.stability import get_stable_machines, get_detected_machines
 from app.services.sensor_processing import process_vibration_data, process_gas_data
-from app.auth import login_required
+from app.services.jobs import BackgroundJobs
+from app.auth import authenticate
+
+logger = logging.getLogger(__name__)
 
 profiles_bp = Blueprint('profiles', __name__)
+# Every route here is protected, so resolve the caller once per request
+profiles_bp.before_request(authenticate)
 
 FREQ_BIN_SIZE = 15
 MIN_CLUSTER_SAMPLES = 15
 
+# live_status is polled by the dashboard; detection history only moves when a
+# live batch arrives, so one answer per user per second is plenty.
+_live_status_cache = TTLCache(maxsize=1024, ttl=1)
+_live_status_lock = Lock()
+
+# Profile builds run here; the job state lives in the database, so any worker
+# process can answer the poll
+PROFILE_JOBS = BackgroundJobs(
+    "profile_build",
+    max_workers=2,
+    max_backlog=int(os.getenv('PROFILE_MAX_BACKLOG', '8'))
+)
+
 @profiles_bp.route("/save_profile", methods=["POST"])
-@login_required
 def save_profile():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
+    """Queue a profile build and return a job id to poll.
+    Building reads up to 3000 calibration rows and clusters them, so it runs
+    on PROFILE_EXECUTOR instead of holding the request thread.
+    """
+    data = request.get_json(force=True)
+    machine_id = data.get("machine_id")
+    vibration_samples = data.get("vibration_samples", [])
+    gas_samples = data.get("gas_samples", [])
+
+    logger.debug("save_profile received: machine_id=%s user=%s", machine_id, g.user_id)
+
+    if not machine_id:
+        return jsonify({"error": "machine_id required"}), 400
 
     try:
-        data = request.get_json(force=True)
-        machine_id = data.get("machine_id")
-        vibration_samples = data.get("vibration_samples", [])
-        gas_samples = data.get("gas_samples", [])
-        
-        print(f"[DEBUG] save_profile received: machine_id={machine_id} user={user_id}")
+        job_id = PROFILE_JOBS.submit(g.user_id, build_profile, g.user_id, machine_id, vibration_samples, gas_samples)
+    except Exception as e:
+        logger.error("SAVE_PROFILE ERROR: %s", e)
+        return jsonify({"error": "server error"}), 500
+    if job_id is None:
+        return jsonify({"error": "Too many profile builds in progress, try again shortly"}), 503
+    return jsonify({"status": "pending", "job_id": job_id}), 202
+
+@profiles_bp.route("/save_profile/<job_id>", methods=["GET"])
+def save_profile_result(job_id):
+    try:
+        job = PROFILE_JOBS.result(job_id, g.user_id)
+    except Exception as e:
+        logger.error("SAVE_PROFILE ERROR: %s", e)
+        return jsonify({"error": "server error"}), 500
+    if job is None:
+        return jsonify({"error": "Unknown profile job"}), 404
+
+    status, body = job
+    if status is None:
+        return jsonify({"status": "pending", "job_id": job_id}), 202
+    # Stored as JSON text already; pass it straight through
+    return Response(body, status=status, mimetype='application/json')
 
-        if not machine_id:
-            return jsonify({"error": "machine_id required"}), 400
+def build_profile(user_id, machine_id, vibration_samples, gas_samples):
+    """Cluster a machine's calibration peaks and upsert its profile.
+    Returns (response_body, http_status).
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
 
-        # Process vibration data via service
-        vibration_data = process_vibration_data(vibration_samples)
+        try:
+            # Process vibration data via service
+            vibration_data = process_vibration_data(vibration_samples)
         
-        # Process gas data via service
-        gas_data = process_gas_data(gas_samples)
-
-        # Fetch calibration data for THIS user
-        cursor.execute(
-            "SELECT peaks FROM raw_audio WHERE user_id = %s AND machine_id = %s AND mode = 'calibration' ORDER BY timestamp DESC LIMIT 3000", 
-            (user_id, machine_id)
-        )
-        rows = cursor.fetchall()
-
-        if not rows:
-            return jsonify({"error": "No calibration data found"}), 400
-
-        all_frequencies = []
-        for (peaks,) in rows:
-            if peaks:
-                sorted_peaks = sorted([p for p in peaks if isinstance(p, dict) and p.get("freq", 0) > 0], key=lambda x: x.get("amp", 0), reverse=True)[:5]
-                for p in sorted_peaks:
-                    freq = p.get("freq")
-                    amp = p.get("amp", 0)
-                    if freq and freq > 0 and amp >= 0.1:
-                        all_frequencies.append(freq)
-
-        if len(all_frequencies) < 20:
-            return jsonify({"error": f"Not enough valid frequencies ({len(all_frequencies)} < 20)"}), 400
-
-        clusters = {}
-        for freq in all_frequencies:
-            bucket = round(freq / FREQ_BIN_SIZE) * FREQ_BIN_SIZE
-            clusters.setdefault(bucket, []).append(freq)
-
-        freq_bands = []
-        for bucket, freqs in sorted(clusters.items()):
-            if len(freqs) < MIN_CLUSTER_SAMPLES: continue
-            freqs_sorted = sorted(freqs)
-            n = len(freqs_sorted)
-            q1 = freqs_sorted[n // 4]
-            q3 = freqs_sorted[3 * n // 4]
-            center = sum(freqs_sorted) / n
+            # Process gas data via service
+            gas_data = process_gas_data(gas_samples)
+
+            # Fetch calibration data for THIS user. The JSONB peaks stream through a
+            # server-side cursor instead of being materialized all at once, and the
+            # selected peaks go into packed double arrays rather than lists of floats.
+            scan = conn.cursor(name="calibration_peaks")
+            scan.itersize = 500
+            found = False
+            freqs = array('d')
+            amps = array('d')
+            amp_key = lambda p: p.get("amp", 0)
+            try:
+                scan.execute(
+                    "SELECT peaks FROM raw_audio WHERE user_id = %s AND machine_id = %s AND mode = 'calibration' ORDER BY timestamp DESC LIMIT 3000", 
+                    (user_id, machine_id)
+                )
+                for (peaks,) in scan:
+                    found = True
+                    if not peaks:
+                        continue
+                    # Only the five loudest peaks per frame matter; nlargest avoids a full sort
+                    top = heapq.nlargest(5, (p for p in peaks if type(p) is dict and p.get("freq", 0) > 0), key=amp_key)
+                    freqs.extend([p["freq"] for p in top])
+                    amps.extend([p.get("amp", 0) for p in top])
+            finally:
+                scan.close()
+
+            if not found:
+                return {"error": "No calibration data found"}, 400
+
+            freqs = np.frombuffer(freqs, dtype=np.float64)
+            amps = np.frombuffer(amps, dtype=np.float64)
+            all_frequencies = np.sort(freqs[(freqs > 0) & (amps >= 0.1)])
+            n_total = len(all_frequencies)
+
+            if n_total < 20:
+                return {"error": f"Not enough valid frequencies ({n_total} < 20)"}, 400
+
+            # Buckets of sorted frequencies are monotonic, so every cluster is a
+            # contiguous, already-sorted slice of all_frequencies
+            # Only bucket identity matters, so keep the integer bucket index and
+            # skip scaling it back to Hz; np.unique on int64 is cheaper than on floats
+            buckets = np.rint(all_frequencies / FREQ_BIN_SIZE).astype(np.int64)
+            _, starts, counts = np.unique(buckets, return_index=True, return_counts=True)
+            centers = np.add.reduceat(all_frequencies, starts) / counts
+            keep = counts >= MIN_CLUSTER_SAMPLES
+            starts, counts, centers = starts[keep], counts[keep], centers[keep]
+            band_q1 = all_frequencies[starts + counts // 4]
+            band_q3 = all_frequencies[starts + 3 * counts // 4]
+            band_iqr = band_q3 - band_q1
+            band_low = np.maximum(0, band_q1 - 0.5 * band_iqr)
+            band_high = band_q3 + 0.5 * band_iqr
+
+            freq_bands = [
+                {"center": round(float(c), 2), "low": round(float(lo), 2), "high": round(float(hi), 2), "samples": int(n)}
+                for c, lo, hi, n in zip(centers, band_low, band_high, counts)
+            ]
+            # Selection, not a full sort: only the five best-populated bands are kept
+            freq_bands = heapq.nlargest(5, freq_bands, key=lambda x: x["samples"])
+            freq_bands = sorted(freq_bands, key=lambda x: x["center"])
+
+            # all_frequencies is already sorted for the bucketing above, so the
+            # overall quartiles are plain index lookups with no second sort
+            q1, median_freq, q3 = all_frequencies[[int(p * (n_total - 1)) for p in (0.25, 0.5, 0.75)]].tolist()
             iqr = q3 - q1
-            band_low = max(0, q1 - 0.5 * iqr)
-            band_high = q3 + 0.5 * iqr
-            freq_bands.append({"center": round(center, 2), "low": round(band_low, 2), "high": round(band_high, 2), "samples": n})
-
-        freq_bands = sorted(freq_bands, key=lambda x: x["samples"], reverse=True)[:5]
-        freq_bands = sorted(freq_bands, key=lambda x: x["center"])
-
-        all_frequencies.sort()
-        def percentile(vals, p): return vals[int(p * (len(vals) - 1))]
-        median_freq = percentile(all_frequencies, 0.5)
-        q1 = percentile(all_frequencies, 0.25)
-        q3 = percentile(all_frequencies, 0.75)
-        iqr = q3 - q1
-        iqr_low = max(0, q1 - 0.5 * iqr)
-        iqr_high = q3 + 0.5 * iqr
-
-        cursor.execute(
-            """
-            INSERT INTO machine_profiles
-                (machine_id, user_id, median_freq, iqr_low, iqr_high, freq_bands, vibration_data, gas_data, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-            ON CONFLICT (user_id, machine_id)
-            DO UPDATE SET
-                median_freq = EXCLUDED.median_freq,
-                iqr_low = EXCLUDED.iqr_low,
-                iqr_high = EXCLUDED.iqr_high,
-                freq_bands = EXCLUDED.freq_bands,
-                vibration_data = EXCLUDED.vibration_data,
-                gas_data = EXCLUDED.gas_data,
-                updated_at = NOW()
-            """,
-            (machine_id, user_id, median_freq, iqr_low, iqr_high, psycopg2.extras.Json(freq_bands),
-             psycopg2.extras.Json(vibration_data) if vibration_data else None,
-             psycopg2.extras.Json(gas_data) if gas_data else None)
-        )
-        conn.commit()
-
-        print(f"\n=== PROFILE CREATED: {machine_id} ===")
-        return jsonify({
-            "status": "profile_saved",
-            "machine_id": machine_id,
-            "median_freq": round(median_freq, 2),
-            "freq_bands": freq_bands,
-            "vibration_data": vibration_data,
-            "gas_data": gas_data
-        })
+            iqr_low = max(0, q1 - 0.5 * iqr)
+            iqr_high = q3 + 0.5 * iqr
 
-    except Exception as e:
-        conn.rollback()
-        print("[ERROR] SAVE_PROFILE ERROR:", str(e))
-        traceback.print_exc()
-        return jsonify({"error": "server error"}), 500
-    finally:
-        cursor.close()
+            cursor.execute(
+                """
+                INSERT INTO machine_profiles
+                    (machine_id, user_id, median_freq, iqr_low, iqr_high, freq_bands, vibration_data, gas_data, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+                ON CONFLICT (user_id, machine_id)
+                DO UPDATE SET
+                    median_freq = EXCLUDED.median_freq,
+                    iqr_low = EXCLUDED.iqr_low,
+                    iqr_high = EXCLUDED.iqr_high,
+                    freq_bands = EXCLUDED.freq_bands,
+                    vibration_data = EXCLUDED.vibration_data,
+                    gas_data = EXCLUDED.gas_data,
+                    updated_at = NOW()
+                """,
+                (machine_id, user_id, median_freq, iqr_low, iqr_high, psycopg2.extras.Json(freq_bands),
+                 psycopg2.extras.Json(vibration_data) if vibration_data else None,
+                 psycopg2.extras.Json(gas_data) if gas_data else None)
+            )
+            conn.commit()
+            invalidate_profiles(user_id)
 
-@profiles_bp.route("/profiles", methods=["GET"])
-@login_required
-def get_profiles():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
-    try:
-        cursor.execute("SELECT machine_id, median_freq, iqr_low, iqr_high, freq_bands, vibration_data, gas_data, created_at FROM machine_profiles WHERE user_id = %s ORDER BY machine_id", (user_id,))
-        rows = cursor.fetchall()
-        profiles = []
-        for row in rows:
-            machine_id, median_freq, iqr_low, iqr_high, freq_bands, vibration_data, gas_data, created_at = row
-            iqr_val = round(iqr_high - iqr_low, 2) if (iqr_low is not None and iqr_high is not None) else None
-            
-            vibration_status_text = None
-            if vibration_data and "vibration_percent" in vibration_data:
-                percent = vibration_data["vibration_percent"]
-                if percent >= 99.9: vibration_status_text = "Always vibrating"
-                elif percent <= 0.1: vibration_status_text = "No vibration detected"
-                else: vibration_status_text = f"Intermittent vibration: {percent:.1f}% active"
-
-            profiles.append({
+            logger.info("PROFILE CREATED: %s", machine_id)
+            return {
+                "status": "profile_saved",
                 "machine_id": machine_id,
-                "median_freq": round(median_freq, 2) if median_freq else None,
-                "iqr_low": round(iqr_low, 2) if iqr_low else None,
-                "iqr_high": round(iqr_high, 2) if iqr_high else None,
-                "iqr": iqr_val,
-                "freq_bands": freq_bands or [],
+                "median_freq": round(median_freq, 2),
+                "freq_bands": freq_bands,
                 "vibration_data": vibration_data,
-                "vibration_status_text": vibration_status_text,
-                "gas_data": gas_data,
-                "created_at": str(created_at) if created_at else None
-            })
-        return jsonify(profiles)
-    except Exception as e:
-        print("[ERROR] GET_PROFILES ERROR:", str(e))
-        return jsonify([]), 200
-    finally:
-        cursor.close()
+                "gas_data": gas_data
+            }, 200
+
+        except Exception as e:
+            conn.rollback()
+            logger.exception("SAVE_PROFILE ERROR: %s", e)
+            return {"error": "server error"}, 500
+        finally:
+            cursor.close()
+
+@profiles_bp.route("/profiles", methods=["GET"])
+def get_profiles():
+    user_id = g.user_id
+    # Named (server-side) cursors need a transaction, so this read uses get_db()
+    with get_db() as conn:
+        # Rows stream in itersize chunks instead of being materialized twice
+        # (once as a fetchall() list, once as the response)
+        cursor = conn.cursor(name="profiles_iter", cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = 200
+        try:
+            cursor.execute("SELECT machine_id, median_freq, iqr_low, iqr_high, freq_bands, vibration_data, gas_data, created_at::text AS created_at FROM machine_profiles WHERE user_id = %s ORDER BY machine_id", (user_id,))
+            profiles = []
+            # Rows are already dicts; only the derived display fields are filled in here
+            for profile in cursor:
+                median_freq, iqr_low, iqr_high = profile["median_freq"], profile["iqr_low"], profile["iqr_high"]
+                vibration_data = profile["vibration_data"]
+
+                vibration_status_text = None
+                if vibration_data and "vibration_percent" in vibration_data:
+                    percent = vibration_data["vibration_percent"]
+                    if percent >= 99.9: vibration_status_text = "Always vibrating"
+                    elif percent <= 0.1: vibration_status_text = "No vibration detected"
+                    else: vibration_status_text = f"Intermittent vibration: {percent:.1f}% active"
+
+                profile["median_freq"] = round(median_freq, 2) if median_freq else None
+                profile["iqr_low"] = round(iqr_low, 2) if iqr_low else None
+                profile["iqr_high"] = round(iqr_high, 2) if iqr_high else None
+                profile["iqr"] = round(iqr_high - iqr_low, 2) if (iqr_low is not None and iqr_high is not None) else None
+                profile["freq_bands"] = profile["freq_bands"] or []
+                profile["vibration_status_text"] = vibration_status_text
+                profiles.append(profile)
+            return jsonify(profiles)
+        except Exception as e:
+            logger.error("GET_PROFILES ERROR: %s", e)
+            return jsonify([]), 200
+        finally:
+            cursor.close()
 
 @profiles_bp.route("/delete_profile", methods=["POST"])
-@login_required
 def delete_profile():
-    conn = get_db()
-    cursor = conn.cursor()
-    user_id = session['user_id']
-    try:
-        data = request.get_json(force=True)
-        machine_id = data.get("machine_id")
-        if not machine_id: return jsonify({"error": "machine_id required"}), 400
+    user_id = g.user_id
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            data = request.get_json(force=True)
+            machine_id = data.get("machine_id")
+            if not machine_id: return jsonify({"error": "machine_id required"}), 400
         
-        cursor.execute("DELETE FROM machine_profiles WHERE machine_id = %s AND user_id = %s", (machine_id, user_id))
-        deleted_count = cursor.rowcount
-        conn.commit()
+            cursor.execute("DELETE FROM machine_profiles WHERE machine_id = %s AND user_id = %s", (machine_id, user_id))
+            deleted_count = cursor.rowcount
+            conn.commit()
+            invalidate_profiles(user_id)
         
-        if deleted_count > 0:
-            return jsonify({"status": "profile_deleted", "machine_id": machine_id})
-        else:
-            return jsonify({"error": f"No profile found for {machine_id}"}), 404
-    except Exception as e:
-        conn.rollback()
-        print("[ERROR] DELETE_PROFILE ERROR:", str(e))
-        return jsonify({"error": "server error"}), 500
-    finally:
-        cursor.close()
+            if deleted_count > 0:
+                return jsonify({"status": "profile_deleted", "machine_id": machine_id})
+            else:
+                return jsonify({"error": f"No profile found for {machine_id}"}), 404
+        except Exception as e:
+            conn.rollback()
+            logger.error("DELETE_PROFILE ERROR: %s", e)
+            return jsonify({"error": "server error"}), 500
+        finally:
+            cursor.close()
 
 @profiles_bp.route("/live_status", methods=["GET"])
-@login_required
 def live_status():
-    conn = get_db()
-    user_id = session['user_id']
+    user_id = g.user_id
+    with _live_status_lock:
+        cached = _live_status_cache.get(user_id)
+    if cached is not None:
+        return jsonify(cached)
+
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT machine_id FROM machine_profiles WHERE user_id = %s", (user_id,))
-        all_machines = [row[0] for row in cursor.fetchall()]
-        cursor.close()
-        
+        all_machines = get_all_machines(user_id)
         stable = get_stable_machines(user_id, all_machines)
-        
-        # Get raw detection history from stability service direct look-up
-        detected = []
-        user_history = detection_history.get(user_id, {})
-        for machine_id in all_machines:
-            if machine_id in user_history and user_history[machine_id] and user_history[machine_id][-1] == 1:
-                detected.append(machine_id)
-        
-        return jsonify({"detected": sorted(detected), "stable": sorted(stable)})
+        detected = get_detected_machines(user_id, all_machines)
+
+        status = {"detected": sorted(detected), "stable": sorted(stable)}
+        with _live_status_lock:
+            _live_status_cache[user_id] = status
+        return jsonify(status)
     except Exception as e:
-        print(f"[ERROR] LIVE_STATUS ERROR: {str(e)}")
+        logger.error("LIVE_STATUS ERROR: %s", e)
         return jsonify({"detected": [], "stable": []})
@@ -1,4 +1,6 @@
-from flask import Blueprint, send_file, render_template, request, session, redirect, url_for, jsonify
+from flask import Blueprint, send_file, render_template, request, session, redirect, url_for, jsonify, make_response
+from functools import lru_cache, wraps
+import hashlib
 import os
 from app.auth import login_required, verify_google_token, get_or_create_user
 
@@ -7,11 +9,48 @@ ui_bp = Blueprint('ui', __name__)
 # Base directory for the app (app/)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Static files served by this blueprint, resolved once at import
+ESP32_DASHBOARD_HTML = os.path.join(BASE_DIR, "templates", "esp32_dashboard.html")
+SESSION_PREVIEW_HTML = os.path.join(BASE_DIR, "templates", "session_preview.html")
+
+@lru_cache(maxsize=64)
+def _strong_etag(path, mtime_ns, size):
+    return hashlib.sha256(f"{mtime_ns}|{size}|{path}".encode()).hexdigest()
+
+def conditional_static(path, max_age=86400):
+    """Serve `path` with a strong ETag and answer matching If-None-Match with 304.
+
+    The ETag is derived from mtime/size, so the handler (and the file read)
+    is skipped entirely on a revalidation hit. HTML pages pass max_age=0 so
+    browsers always revalidate them.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            st = os.stat(path)
+            etag = _strong_etag(path, st.st_mtime_ns, st.st_size)
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = f"public, max-age={max_age}, must-revalidate"
+            return response
+        return wrapper
+    return decorator
+
+# login.html and gemini_analysis.html depend only on process-wide settings
+# (GOOGLE_CLIENT_ID, the static URL prefix), so each is rendered by Jinja once
+# per process, on first use inside a request, and then served from memory.
+@lru_cache(maxsize=None)
+def _render_page(template_name, **context):
+    return render_template(template_name, **context)
+
 @ui_bp.route("/login")
 def login():
     if 'user_id' in session:
         return redirect(url_for('ui.index'))
-    return render_template("login.html", google_client_id=os.getenv('GOOGLE_CLIENT_ID'))
+    return _render_page("login.html", google_client_id=os.getenv('GOOGLE_CLIENT_ID'))
 
 @ui_bp.route("/auth/google", methods=["POST"])
 def google_auth():
@@ -58,27 +97,19 @@ def index():
         return f"ERROR: {str(e)}\n{traceback.format_exc()}", 500
 
 @ui_bp.route("/esp32")
+@conditional_static(ESP32_DASHBOARD_HTML, max_age=0)
 def esp32_dashboard():
     """Serve ESP32 sensor monitoring dashboard"""
-    return send_file(os.path.join(BASE_DIR, "templates", "esp32_dashboard.html"))
-
-@ui_bp.route("/esp32_style.css")
-def esp32_style():
-    """Serve ESP32 dashboard CSS"""
-    return send_file(os.path.join(BASE_DIR, "static", "css", "esp32_style.css"))
-
-@ui_bp.route("/esp32_app.js")
-def esp32_app():
-    """Serve ESP32 dashboard JavaScript"""
-    return send_file(os.path.join(BASE_DIR, "static", "js", "esp32_app.js"))
+    return send_file(ESP32_DASHBOARD_HTML, etag=False)
 
 @ui_bp.route("/session-preview-page")
+@conditional_static(SESSION_PREVIEW_HTML, max_age=0)
 def session_preview_page():
     """Serve the session preview debug page"""
-    return send_file(os.path.join(BASE_DIR, "templates", "session_preview.html"))
+    return send_file(SESSION_PREVIEW_HTML, etag=False)
 
 @ui_bp.route("/gemini-analysis")
 @login_required
 def gemini_analysis_page():
     """Serve the Gemini analysis page"""
-    return render_template("gemini_analysis.html")
+    return _render_page("gemini_analysis.html")
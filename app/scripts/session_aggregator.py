@@ -6,15 +6,82 @@ Produces a token-efficient JSON payload for Gemini (without calling it).
 This module is ADDITIVE - it does NOT modify any existing tables or logic.
 """
 
+import copy
+import hashlib
+import logging
 import os
-import json
+import orjson
 import re
 import requests
-from datetime import datetime
+import sys
+from bisect import bisect_left
+from cachetools import TTLCache
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import Event, Lock
+from urllib3.util.retry import Retry
+from app.db import prepare
+
+try:
+    from json_repair import repair_json
+except ImportError:  # optional: fall back to the bracket-balancing heuristic
+    repair_json = None
+
+logger = logging.getLogger(__name__)
 
 # Gemini API key from environment
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# Extra attempts when the TCP/TLS connect itself fails; nothing was sent yet
+GEMINI_CONNECT_RETRIES = 2
+
+# One pooled session for all Gemini calls: the TLS connection to
+# generativelanguage.googleapis.com is reused across sessions and across
+# fallback models instead of being re-established per request.
+# Only failed connects are retried here (nothing was sent yet); transient 5xx
+# responses are retried by _try_model itself so a hedged loser can stop between
+# attempts. A read timeout is never retried (read=False re-raises it as-is):
+# the POST may already be generating, and be billed, and hedging to the next
+# model is the cheaper way to cut the tail.
+_gemini_http = requests.Session()
+_gemini_http.headers.update({"Content-Type": "application/json"})
+_gemini_http.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=None,
+        connect=GEMINI_CONNECT_RETRIES,
+        read=False,
+        status=0,
+        other=0,
+        backoff_factor=0.5,
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False,
+    ),
+))
+
+# 5xx answers are retried this many times per model, backing off 0.5 s, 1 s, 2 s
+GEMINI_STATUS_RETRIES = 3
+GEMINI_RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+# (connect, read) timeouts: fail fast on an unreachable host, allow slow generation
+GEMINI_TIMEOUT = (5, 30)
+
+# Seconds to wait on the in-flight model(s) before hedging with the next one
+GEMINI_HEDGE_DELAY = float(os.getenv('GEMINI_HEDGE_DELAY', '2.0'))
+# Shared by every analysis, so the number of model requests in flight at once
+# (winners and losers still finishing their current attempt) is capped here
+_gemini_hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('GEMINI_HEDGE_WORKERS', '16')),
+    thread_name_prefix="gemini-hedge"
+)
+
+# Successful analyses keyed by a hash of the session payload
+GEMINI_CACHE_TTL = 300
+_gemini_cache = TTLCache(maxsize=512, ttl=GEMINI_CACHE_TTL)
+_gemini_cache_lock = Lock()
+
 # FIXED: Use ONLY valid Gemini models with FULL names (confirmed by ListModels)
 # Order: cheapest/fastest first for fallback
 GEMINI_MODELS = [
@@ -29,6 +96,47 @@ GEMINI_MODELS = [
 # ROBUST JSON EXTRACTION & NORMALIZATION (Safety-Critical)
 # =============================================================================
 
+# Compiled once; these run on every Gemini response
+_FENCE_PATTERNS = (
+    re.compile(r'```json\s*([\s\S]*?)\s*```', re.IGNORECASE),  # ```json ... ```
+    re.compile(r'```\s*([\s\S]*?)\s*```', re.IGNORECASE),       # ``` ... ```
+)
+_JSON_TOKENS = re.compile(r'[{}"\\]')
+_REPAIR_TOKENS = re.compile(r'[{}\[\]"\\]')
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+
+def _balanced_object_spans(text: str) -> list:
+    """
+    Return (start, end) for every balanced {...} in text, found in a single
+    left-to-right pass. Braces inside JSON strings are ignored. Spans are
+    ordered by start, so outer objects are tried before the ones nested in them.
+    """
+    spans = []
+    stack = []
+    in_string = False
+    skip_to = 0
+    for m in _JSON_TOKENS.finditer(text):
+        i = m.start()
+        if i < skip_to:
+            continue
+        ch = text[i]
+        if in_string:
+            if ch == '\\':
+                skip_to = i + 2  # escaped character, e.g. \"
+            elif ch == '"':
+                in_string = False
+        elif ch == '{':
+            stack.append(i)
+        elif ch == '}':
+            if stack:
+                spans.append((stack.pop(), i + 1))
+        elif ch == '"' and stack:
+            in_string = True
+    spans.sort()
+    return spans
+
+
 def extract_json_from_text(text: str) -> tuple:
     """
     Extract the FIRST valid JSON object from text that may contain:
@@ -43,65 +151,54 @@ def extract_json_from_text(text: str) -> tuple:
         return None, "Empty response"
     
     original_text = text
+
+    # Step 0: A bare JSON object (what JSON mode returns) needs no scanning.
+    # This is also the only way the whole text can parse to a dict.
+    stripped = text.strip()
+    if stripped[:1] == '{' and stripped[-1:] == '}':
+        try:
+            parsed = orjson.loads(stripped)
+            if isinstance(parsed, dict):
+                logger.debug("JSON_EXTRACT: whole text is valid JSON")
+                return parsed, None
+        except orjson.JSONDecodeError:
+            pass
     
     # Step 1: Try to extract from markdown code fences
     # Matches ```json ... ``` or ``` ... ```
-    fence_patterns = [
-        r'```json\s*([\s\S]*?)\s*```',  # ```json ... ```
-        r'```\s*([\s\S]*?)\s*```',       # ``` ... ```
-    ]
-    
-    for pattern in fence_patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
+    for pattern in _FENCE_PATTERNS:
+        matches = pattern.findall(text)
         for match in matches:
             try:
-                parsed = json.loads(match.strip())
+                parsed = orjson.loads(match.strip())
                 if isinstance(parsed, dict):
-                    print(f"[JSON_EXTRACT] ✅ Extracted from markdown fence ({len(match)} chars)")
+                    logger.debug("JSON_EXTRACT: extracted from markdown fence (%d chars)", len(match))
                     return parsed, None
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 continue
     
     # Step 2: Try to find JSON object directly using brace matching
-    # Find all potential JSON starts
-    json_starts = [m.start() for m in re.finditer(r'\{', text)]
-    
-    for start in json_starts:
-        # Try progressively longer substrings
-        brace_count = 0
-        end = start
-        
-        for i, char in enumerate(text[start:], start):
-            if char == '{':
-                brace_count += 1
-            elif char == '}':
-                brace_count -= 1
-                if brace_count == 0:
-                    end = i + 1
-                    break
-        
-        if end > start:
-            candidate = text[start:end]
-            try:
-                parsed = json.loads(candidate)
-                if isinstance(parsed, dict):
-                    print(f"[JSON_EXTRACT] ✅ Extracted JSON object ({len(candidate)} chars)")
-                    return parsed, None
-            except json.JSONDecodeError:
-                continue
-    
-    # Step 3: Try the whole text as JSON
-    try:
-        parsed = json.loads(text.strip())
-        if isinstance(parsed, dict):
-            print(f"[JSON_EXTRACT] ✅ Whole text is valid JSON")
-            return parsed, None
-    except json.JSONDecodeError:
-        pass
+    for start, end in _balanced_object_spans(text):
+        candidate = text[start:end]
+        try:
+            parsed = orjson.loads(candidate)
+            if isinstance(parsed, dict):
+                logger.debug("JSON_EXTRACT: extracted JSON object (%d chars)", len(candidate))
+                return parsed, None
+        except orjson.JSONDecodeError:
+            continue
     
     return None, f"No valid JSON found in {len(text)} chars of text"
 
 
+def _strip_trailing_commas(text: str) -> str:
+    """Drop commas directly preceding '}' or ']' in a single scan."""
+    # Most payloads have no trailing comma at all; str.find is C-fast
+    if text.find(',') == -1:
+        return text
+    return _TRAILING_COMMA.sub(r'\1', text)
+
+
 def attempt_json_repair(text: str) -> tuple:
     """
     Attempt to repair common JSON issues:
@@ -121,12 +218,38 @@ def attempt_json_repair(text: str) -> tuple:
         return None, "No JSON object start found"
     
     text = text[json_start:]
+
+    # json_repair also handles single quotes, unquoted keys, Python literals
+    # and raw newlines in strings; the bracket heuristic below is the fallback
+    if repair_json is not None:
+        try:
+            parsed = repair_json(text, return_objects=True)
+        except Exception:
+            parsed = None
+        if isinstance(parsed, dict) and parsed:
+            logger.debug("JSON_REPAIR: repaired with json_repair")
+            return parsed, None
     
-    # Count braces
-    open_braces = text.count('{')
-    close_braces = text.count('}')
-    open_brackets = text.count('[')
-    close_brackets = text.count(']')
+    # Count braces/brackets in one pass, ignoring any inside JSON strings
+    counts = {'{': 0, '}': 0, '[': 0, ']': 0}
+    in_string = False
+    skip_to = 0
+    for m in _REPAIR_TOKENS.finditer(text):
+        i = m.start()
+        if i < skip_to:
+            continue
+        ch = text[i]
+        if in_string:
+            if ch == '\\':
+                skip_to = i + 2
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch != '\\':
+            counts[ch] += 1
+    open_braces, close_braces = counts['{'], counts['}']
+    open_brackets, close_brackets = counts['['], counts[']']
     
     # Add missing closing braces/brackets
     repaired = text
@@ -134,31 +257,32 @@ def attempt_json_repair(text: str) -> tuple:
     repaired += '}' * (open_braces - close_braces)
     
     # Remove trailing commas before closing braces/brackets
-    repaired = re.sub(r',\s*}', '}', repaired)
-    repaired = re.sub(r',\s*]', ']', repaired)
+    repaired = _strip_trailing_commas(repaired)
     
     try:
-        parsed = json.loads(repaired)
+        parsed = orjson.loads(repaired)
         if isinstance(parsed, dict):
-            print(f"[JSON_REPAIR] ✅ Successfully repaired JSON")
+            logger.debug("JSON_REPAIR: repaired by bracket balancing")
             return parsed, None
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         return None, f"Repair failed: {str(e)}"
     
     return None, "Repair produced non-dict result"
 
 
+_CRLF_TABLE = str.maketrans({'\n': ' ', '\r': None})
+
+
 def create_fallback_response(raw_text: str, reason: str) -> dict:
     """
     Create a safe fallback JSON response when parsing fails.
     Preserves the raw output for manual review.
     """
-    safe_observation = raw_text[:300] if raw_text else "No output received"
-    safe_notes = raw_text[:500] if raw_text else "No output received"
+    raw_text = raw_text or "No output received"
     
-    # Escape any problematic characters
-    safe_observation = safe_observation.replace('\n', ' ').replace('\r', '')
-    safe_notes = safe_notes.replace('\n', ' ').replace('\r', '')
+    # Escape any problematic characters (one translate pass per slice)
+    safe_observation = raw_text[:300].translate(_CRLF_TABLE)
+    safe_notes = raw_text[:500].translate(_CRLF_TABLE)
     
     return {
         "health_status": "WARNING",
@@ -179,26 +303,32 @@ def create_fallback_response(raw_text: str, reason: str) -> dict:
     }
 
 
+_HEALTH_STATES = frozenset({"NORMAL", "WARNING", "CRITICAL"})
+_SEVERITIES = frozenset({"LOW", "MEDIUM", "HIGH"})
+# Empty lists here are never mutated: validation replaces them with new lists
+_SCHEMA_DEFAULTS = {
+    "health_status": "WARNING",
+    "key_findings": [],
+    "overall_severity": "MEDIUM",
+    "recommended_actions": [],
+    "notes": ""
+}
+
+
 def validate_analysis_schema(data: dict) -> dict:
     """
     Validate and normalize the analysis response to match expected schema.
     Fills in missing fields with safe defaults.
     """
     # Expected schema with defaults
-    validated = {
-        "health_status": data.get("health_status", "WARNING"),
-        "key_findings": data.get("key_findings", []),
-        "overall_severity": data.get("overall_severity", "MEDIUM"),
-        "recommended_actions": data.get("recommended_actions", []),
-        "notes": data.get("notes", "")
-    }
+    validated = {**_SCHEMA_DEFAULTS, **{k: data[k] for k in _SCHEMA_DEFAULTS if k in data}}
     
-    # Validate health_status
-    if validated["health_status"] not in ["NORMAL", "WARNING", "CRITICAL"]:
+    # Validate health_status (isinstance first: unhashable values can't be set members)
+    if not isinstance(validated["health_status"], str) or validated["health_status"] not in _HEALTH_STATES:
         validated["health_status"] = "WARNING"
     
     # Validate severity
-    if validated["overall_severity"] not in ["LOW", "MEDIUM", "HIGH"]:
+    if not isinstance(validated["overall_severity"], str) or validated["overall_severity"] not in _SEVERITIES:
         validated["overall_severity"] = "MEDIUM"
     
     # Ensure key_findings is a list
@@ -242,28 +372,35 @@ def normalize_gemini_response(raw_text: str, model_name: str = "unknown") -> dic
     Returns:
         dict: Valid analysis JSON matching expected schema
     """
-    print(f"[NORMALIZE] Processing response from {model_name} ({len(raw_text) if raw_text else 0} chars)")
+    # Callers get their own copy; the cached dict must never be mutated
+    return copy.deepcopy(_normalize_cached(raw_text, model_name))
+
+
+@lru_cache(maxsize=256)
+def _normalize_cached(raw_text: str, model_name: str) -> dict:
+    """Extract -> repair -> fallback pipeline, memoized so retries of an identical response are free."""
+    logger.debug("NORMALIZE: processing response from %s (%d chars)", model_name, len(raw_text) if raw_text else 0)
     
     # Step 1: Try extraction
     extracted, extract_error = extract_json_from_text(raw_text)
     
     if extracted:
-        print(f"[NORMALIZE] ✅ Extraction succeeded")
+        logger.debug("NORMALIZE: extraction succeeded")
         return validate_analysis_schema(extracted)
     
-    print(f"[NORMALIZE] ⚠️ Extraction failed: {extract_error}")
+    logger.debug("NORMALIZE: extraction failed: %s", extract_error)
     
     # Step 2: Try repair
     repaired, repair_error = attempt_json_repair(raw_text)
     
     if repaired:
-        print(f"[NORMALIZE] ✅ Repair succeeded")
+        logger.debug("NORMALIZE: repair succeeded")
         return validate_analysis_schema(repaired)
     
-    print(f"[NORMALIZE] ⚠️ Repair failed: {repair_error}")
+    logger.warning("NORMALIZE: repair failed: %s", repair_error)
     
     # Step 3: Create fallback
-    print(f"[NORMALIZE] ⚠️ Using fallback response")
+    logger.warning("NORMALIZE: using fallback response")
     return create_fallback_response(raw_text, f"Extract: {extract_error}; Repair: {repair_error}")
 
 
@@ -309,15 +446,121 @@ using EXACTLY the following schema:
 SESSION SUMMARY:
 """
 
+GEMINI_GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "maxOutputTokens": 512,
+    # JSON mode: the model returns a bare object, so extraction takes Step 0
+    "responseMimeType": "application/json"
+}
+
+# The request body is the same for every session except for the summary, so
+# everything around it is serialized once at import. The prompt prefix is kept
+# as an open JSON string; the escaped summary and closing quote are appended.
+_BODY_HEAD = b'{"contents":[{"parts":[{"text":' + orjson.dumps(GEMINI_SYSTEM_PROMPT)[:-1]
+_BODY_TAIL = b'}]}],"generationConfig":' + orjson.dumps(GEMINI_GENERATION_CONFIG) + b'}'
+
+
+def build_gemini_request_body(session_data: dict) -> bytes:
+    """Encode the generateContent body: system prompt followed by the compact session JSON."""
+    summary = orjson.dumps(session_data).decode()
+    return _BODY_HEAD + orjson.dumps(summary)[1:] + _BODY_TAIL
+
 
 # =============================================================================
 # GEMINI API CALLER WITH FALLBACK
 # =============================================================================
 
+def _error_detail(response, default):
+    """Pull error.message out of a Gemini error body; `default=None` means the body text."""
+    fallback = response.text[:200] if default is None else default
+    try:
+        return orjson.loads(response.content).get('error', {}).get('message', fallback)
+    except (orjson.JSONDecodeError, AttributeError):
+        return fallback
+
+
+def _try_model(model: str, body: bytes, cancelled: Event) -> tuple:
+    """
+    Send one request to a single Gemini model, retrying transient 5xx answers.
+    
+    `cancelled` is checked before every attempt, so once another hedged model
+    has won, a loser gives up after at most its current request.
+    
+    Returns:
+        tuple: ({"model_used": str, "analysis": dict} or None, error_message or None)
+    """
+    # Model already includes "models/" prefix, use v1beta endpoint
+    url = (
+        f"https://generativelanguage.googleapis.com/v1beta/"
+        f"{model}:generateContent?key={GEMINI_API_KEY}"
+    )
+    
+    try:
+        for attempt in range(GEMINI_STATUS_RETRIES + 1):
+            if cancelled.is_set():
+                return None, f"{model}: cancelled, another model answered first"
+            logger.debug("GEMINI: trying model %s (attempt %d)", model, attempt + 1)
+            response = _gemini_http.post(url, data=body, timeout=GEMINI_TIMEOUT)
+            if response.status_code not in GEMINI_RETRY_STATUSES or attempt == GEMINI_STATUS_RETRIES:
+                break
+            # Event.wait doubles as the backoff sleep and wakes early on cancel
+            cancelled.wait(0.5 * 2 ** attempt)
+        
+        if response.status_code == 200:
+            # Decode the envelope straight from the body bytes with orjson
+            result = orjson.loads(response.content)
+            
+            # Extract raw text; a long answer may be split across parts
+            try:
+                parts = result["candidates"][0]["content"]["parts"]
+                raw_text = "".join(part.get("text", "") for part in parts) if len(parts) > 1 else parts[0]["text"]
+            except (KeyError, IndexError, TypeError, AttributeError) as e:
+                return None, f"{model}: Malformed response structure - {str(e)}"
+            
+            logger.info("GEMINI: got response from %s (%d chars)", model, len(raw_text))
+            
+            # FIXED: Use robust normalizer instead of direct json.loads
+            analysis = normalize_gemini_response(raw_text, model)
+            
+            return {
+                "model_used": model,
+                "analysis": analysis
+            }, None
+        
+        # Handle specific error codes
+        if response.status_code == 400:
+            error_detail = _error_detail(response, "")
+            return None, f"{model}: Invalid request (400) - {error_detail}"
+        
+        if response.status_code in (403, 429):
+            error_detail = _error_detail(response, "")
+            return None, f"{model}: quota/permission denied ({response.status_code}) {error_detail}"
+        
+        # Other errors
+        error_detail = _error_detail(response, None)
+        return None, f"{model}: HTTP {response.status_code} - {error_detail}"
+        
+    except requests.exceptions.ConnectTimeout:
+        return None, (
+            f"{model}: connect timeout ({GEMINI_CONNECT_RETRIES + 1} attempts of {GEMINI_TIMEOUT[0]}s)"
+        )
+    except requests.exceptions.Timeout:
+        # Read timeouts are not retried, so this is a single attempt
+        return None, f"{model}: no response within {GEMINI_TIMEOUT[1]}s"
+    except requests.exceptions.ConnectionError as e:
+        return None, f"{model}: connection error - {str(e)}"
+    except Exception as e:
+        return None, f"{model}: exception {str(e)}"
+
+
 def call_gemini_with_fallback(session_data: dict) -> dict:
     """
     Send session data to Gemini API with model fallback and robust response parsing.
     
+    Models are hedged rather than tried strictly in turn: the next model is
+    started as soon as the previous one fails, or after GEMINI_HEDGE_DELAY
+    seconds without an answer, and the first successful response wins.
+    
     Valid models (from ListModels API):
     - models/gemini-2.0-flash-lite (fastest, cheapest)
     - models/gemini-2.0-flash
@@ -337,93 +580,48 @@ def call_gemini_with_fallback(session_data: dict) -> dict:
     if not GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY not configured")
     
-    # Build compact prompt (token-efficient)
-    prompt = GEMINI_SYSTEM_PROMPT + json.dumps(session_data, separators=(",", ":"))
-    
-    headers = {"Content-Type": "application/json"}
+    # An identical session analyzed moments ago (UI retry, second tab) is
+    # answered from cache instead of paying for another round of API calls
+    cache_key = hashlib.blake2b(
+        orjson.dumps(session_data, option=orjson.OPT_SORT_KEYS), digest_size=16
+    ).digest()
+    with _gemini_cache_lock:
+        cached = _gemini_cache.get(cache_key)
+    if cached is not None:
+        logger.debug("GEMINI: cache hit (%s)", cached["model_used"])
+        return copy.deepcopy(cached)
     
-    # FIXED: Simple payload without responseMimeType
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "generationConfig": {
-            "temperature": 0.2,
-            "maxOutputTokens": 512
-        }
-    }
+    # Build compact prompt (token-efficient), encoded once for every model tried
+    body = build_gemini_request_body(session_data)
     
     last_error = None
-    
-    for model in GEMINI_MODELS:
-        # Model already includes "models/" prefix, use v1beta endpoint
-        url = (
-            f"https://generativelanguage.googleapis.com/v1beta/"
-            f"{model}:generateContent?key={GEMINI_API_KEY}"
-        )
-        
-        try:
-            print(f"[GEMINI] Trying model: {model}")
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Extract raw text
-                try:
-                    raw_text = result["candidates"][0]["content"]["parts"][0]["text"]
-                except (KeyError, IndexError) as e:
-                    last_error = f"{model}: Malformed response structure - {str(e)}"
-                    print(f"[GEMINI] ⚠️ {last_error}")
-                    continue
-                
-                print(f"[GEMINI] ✅ Got response from {model} ({len(raw_text)} chars)")
-                
-                # FIXED: Use robust normalizer instead of direct json.loads
-                analysis = normalize_gemini_response(raw_text, model)
-                
-                return {
-                    "model_used": model,
-                    "analysis": analysis
-                }
-            
-            # Handle specific error codes
-            if response.status_code == 400:
-                error_detail = ""
-                try:
-                    error_detail = response.json().get('error', {}).get('message', '')
-                except:
-                    pass
-                last_error = f"{model}: Invalid request (400) - {error_detail}"
-                print(f"[GEMINI] ⚠️ {last_error}")
-                continue
-            
-            if response.status_code in (403, 429):
-                error_detail = ""
-                try:
-                    error_detail = response.json().get('error', {}).get('message', '')
-                except:
-                    pass
-                last_error = f"{model}: quota/permission denied ({response.status_code}) {error_detail}"
-                print(f"[GEMINI] ⚠️ {last_error}")
-                continue
-            
-            # Other errors
-            error_detail = ""
-            try:
-                error_detail = response.json().get('error', {}).get('message', response.text[:200])
-            except:
-                error_detail = response.text[:200]
-            last_error = f"{model}: HTTP {response.status_code} - {error_detail}"
-            print(f"[GEMINI] ⚠️ {last_error}")
+    remaining = iter(GEMINI_MODELS)
+    # Set once this call returns, so losers stop before their next attempt
+    cancelled = Event()
+    pending = set()
+    try:
+        pending = {_gemini_hedge_executor.submit(_try_model, next(remaining), body, cancelled)}
+        while pending:
+            done, pending = wait(pending, timeout=GEMINI_HEDGE_DELAY, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, error = future.result()
+                if result is not None:
+                    with _gemini_cache_lock:
+                        _gemini_cache[cache_key] = result
+                    return copy.deepcopy(result)
+                last_error = error
+                logger.warning("GEMINI: %s", last_error)
             
-        except requests.exceptions.Timeout:
-            last_error = f"{model}: request timeout (30s)"
-            print(f"[GEMINI] ⚠️ {last_error}")
-        except requests.exceptions.ConnectionError as e:
-            last_error = f"{model}: connection error - {str(e)}"
-            print(f"[GEMINI] ⚠️ {last_error}")
-        except Exception as e:
-            last_error = f"{model}: exception {str(e)}"
-            print(f"[GEMINI] ⚠️ {last_error}")
+            # Either a model failed or the in-flight ones are slow: start the next one
+            model = next(remaining, None)
+            if model is not None:
+                pending.add(_gemini_hedge_executor.submit(_try_model, model, body, cancelled))
+    finally:
+        # Queued losers never start; running ones finish at most their current
+        # request (up to GEMINI_TIMEOUT) and their results are dropped
+        cancelled.set()
+        for future in pending:
+            future.cancel()
     
     # If ALL models fail
     raise RuntimeError(
@@ -455,19 +653,20 @@ def get_latest_data_range(conn, user_id: int, duration_seconds: int = 60) -> dic
     """
     cursor = conn.cursor()
     try:
-        print(f"[DEBUG] get_latest_data_range CHECK user_id={user_id} duration={duration_seconds}")
+        logger.debug("get_latest_data_range CHECK user_id=%s duration=%s", user_id, duration_seconds)
         
-        # Get latest audio timestamp
+        # Get latest audio timestamp (duration is a bound parameter, so the
+        # statement text is identical for every call)
         cursor.execute("""
             SELECT 
-                MAX(timestamp) - INTERVAL '%s seconds' AS start_ts,
+                MAX(timestamp) - make_interval(secs => %s) AS start_ts,
                 MAX(timestamp) AS stop_ts,
                 COUNT(*) AS total_rows
             FROM raw_audio
-            WHERE user_id = %%s
-        """ % duration_seconds, (user_id,))
+            WHERE user_id = %s
+        """, (duration_seconds, user_id))
         row = cursor.fetchone()
-        print(f"[DEBUG] get_latest_data_range ROW: {row}")
+        logger.debug("get_latest_data_range ROW: %s", row)
         
         if not row or not row[1]:
             return {
@@ -482,19 +681,15 @@ def get_latest_data_range(conn, user_id: int, duration_seconds: int = 60) -> dic
         start_ts = row[0]
         stop_ts = row[1]
         
-        # Count audio rows in this range
+        # Count audio and ESP32 rows in this range in one round-trip
         cursor.execute("""
-            SELECT COUNT(*) FROM raw_audio 
-            WHERE user_id = %s AND timestamp BETWEEN %s AND %s
-        """, (user_id, start_ts, stop_ts))
-        audio_count = cursor.fetchone()[0]
-        
-        # Count ESP32 rows in this range
-        cursor.execute("""
-            SELECT COUNT(*) FROM esp32_data 
-            WHERE timestamp BETWEEN %s AND %s
-        """, (start_ts, stop_ts))
-        esp32_count = cursor.fetchone()[0]
+            SELECT
+                (SELECT COUNT(*) FROM raw_audio
+                 WHERE user_id = %s AND timestamp BETWEEN %s AND %s),
+                (SELECT COUNT(*) FROM esp32_data
+                 WHERE user_id = %s AND timestamp BETWEEN %s AND %s)
+        """, (user_id, start_ts, stop_ts, user_id, start_ts, stop_ts))
+        audio_count, esp32_count = cursor.fetchone()
         
         return {
             "has_data": audio_count > 0,
@@ -516,30 +711,26 @@ def validate_time_range(conn, user_id: int, start_ts: str, stop_ts: str) -> dict
     """
     cursor = conn.cursor()
     try:
-        # Count audio rows
+        # Range counts and the user's overall audio boundaries in one round-trip
         cursor.execute("""
-            SELECT COUNT(*) FROM raw_audio 
-            WHERE user_id = %s AND timestamp BETWEEN %s AND %s
-        """, (user_id, start_ts, stop_ts))
-        audio_count = cursor.fetchone()[0]
-        
-        # Count ESP32 rows
-        cursor.execute("""
-            SELECT COUNT(*) FROM esp32_data 
-            WHERE timestamp BETWEEN %s AND %s
-        """, (start_ts, stop_ts))
-        esp32_count = cursor.fetchone()[0]
-        
-        # Get actual data boundaries
-        cursor.execute("SELECT MIN(timestamp), MAX(timestamp) FROM raw_audio WHERE user_id = %s", (user_id,))
-        audio_range = cursor.fetchone()
+            SELECT
+                (SELECT COUNT(*) FROM raw_audio
+                 WHERE user_id = %s AND timestamp BETWEEN %s AND %s),
+                (SELECT COUNT(*) FROM esp32_data
+                 WHERE user_id = %s AND timestamp BETWEEN %s AND %s),
+                MIN(timestamp),
+                MAX(timestamp)
+            FROM raw_audio
+            WHERE user_id = %s
+        """, (user_id, start_ts, stop_ts, user_id, start_ts, stop_ts, user_id))
+        audio_count, esp32_count, audio_earliest, audio_latest = cursor.fetchone()
         
         return {
             "valid": audio_count > 0 or esp32_count > 0,
             "audio_count": audio_count,
             "esp32_count": esp32_count,
-            "audio_earliest": str(audio_range[0]) if audio_range[0] else None,
-            "audio_latest": str(audio_range[1]) if audio_range[1] else None,
+            "audio_earliest": str(audio_earliest) if audio_earliest else None,
+            "audio_latest": str(audio_latest) if audio_latest else None,
             "requested_start": start_ts,
             "requested_stop": stop_ts
         }
@@ -548,6 +739,39 @@ def validate_time_range(conn, user_id: int, start_ts: str, stop_ts: str) -> dict
         cursor.close()
 
 
+# Python 3.11+ fromisoformat() accepts 'Z' and the other ISO 8601 forms directly
+_NATIVE_ISO_PARSE = sys.version_info >= (3, 11)
+
+
+def _parse_session_ts(ts: str) -> datetime:
+    """Parse a client ISO timestamp; UTC ('Z' or '+00:00') comes back naive."""
+    if _NATIVE_ISO_PARSE:
+        dt = datetime.fromisoformat(ts)
+        return dt.replace(tzinfo=None) if dt.utcoffset() == timedelta(0) else dt
+    return datetime.fromisoformat(ts.replace('Z', '+00:00').replace('+00:00', ''))
+
+
+def _fallback_payload(start_ts: str, stop_ts: str, machine_id: str = None, device_id: str = None) -> dict:
+    """Zeroed session payload used when the range is empty or aggregation fails."""
+    return {
+        "machine_id": machine_id or "unknown",
+        "device_id": device_id or "unknown",
+        "session": {
+            "start": start_ts,
+            "stop": stop_ts,
+            "duration_sec": 60.0  # Default fallback
+        },
+        "sound_summary": {
+            "data_mode": "none",
+            "dominant_freq_median": 0,
+            "freq_iqr": [0, 0],
+            "out_of_profile_events": 0
+        },
+        "vibration_summary": {"avg": 0, "peak": 0, "event_count": 0},
+        "gas_summary": {"avg_raw": 0, "peak_raw": 0, "status": "LOW"}
+    }
+
+
 def aggregate_session_data(conn, user_id: int, start_ts: str, stop_ts: str, machine_id: str = None, device_id: str = None):
     """
     Fetch and aggregate data from raw_audio and esp32_data between start and stop timestamps.
@@ -561,57 +785,16 @@ def aggregate_session_data(conn, user_id: int, start_ts: str, stop_ts: str, mach
         device_id: Optional filter for esp32_data
     
     Returns:
-        dict: Aggregated session payload (ready for Gemini)
-    
-    Raises:
-        ValueError: If no data exists in the selected time range
+        dict: Aggregated session payload (ready for Gemini); the zeroed
+        fallback payload when the range is empty or aggregation fails
     """
+    cursor = None
     try:
         cursor = conn.cursor()
 
-        # =====================
-        # 0. VALIDATE TIME RANGE (Hard Guard)
-        # =====================
-        cursor.execute("""
-            SELECT COUNT(*) FROM raw_audio
-            WHERE user_id = %s AND timestamp BETWEEN %s AND %s
-        """, (user_id, start_ts, stop_ts))
-        audio_count = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM esp32_data
-            WHERE timestamp BETWEEN %s AND %s
-        """, (start_ts, stop_ts))
-        esp32_count = cursor.fetchone()[0]
-        
-        if audio_count == 0 and esp32_count == 0:
-            # Return fallback payload instead of error
-            try:
-                duration_sec = 60.0  # Default fallback
-                return {
-                    "machine_id": machine_id or "unknown",
-                    "device_id": device_id or "unknown",
-                    "session": {
-                        "start": start_ts,
-                        "stop": stop_ts,
-                        "duration_sec": duration_sec
-                    },
-                    "sound_summary": {
-                        "data_mode": "none",
-                        "dominant_freq_median": 0,
-                        "freq_iqr": [0, 0],
-                        "out_of_profile_events": 0
-                    },
-                    "vibration_summary": {"avg": 0, "peak": 0, "event_count": 0},
-                    "gas_summary": {"avg_raw": 0, "peak_raw": 0, "status": "LOW"}
-                }
-            except Exception as e:
-                print(f"[ERROR] Failed to create fallback payload: {e}")
-                raise
-        
         # Parse timestamps for duration calculation
-        start_dt = datetime.fromisoformat(start_ts.replace('Z', '+00:00').replace('+00:00', ''))
-        stop_dt = datetime.fromisoformat(stop_ts.replace('Z', '+00:00').replace('+00:00', ''))
+        start_dt = _parse_session_ts(start_ts)
+        stop_dt = _parse_session_ts(stop_ts)
         duration_sec = (stop_dt - start_dt).total_seconds()
         
         # =====================
@@ -626,6 +809,13 @@ def aggregate_session_data(conn, user_id: int, start_ts: str, stop_ts: str, mach
             cursor, user_id, start_ts, stop_ts, device_id
         )
         
+        # =====================
+        # (Hard Guard) Nothing in the time range
+        # =====================
+        # Decided from the aggregates themselves rather than a separate probe
+        if sound_summary.get("data_mode") == "none" and gas_summary.get("status") == "NO_DATA":
+            return _fallback_payload(start_ts, stop_ts, machine_id, device_id)
+        
         # =====================
         # 3. BUILD FINAL PAYLOAD
         # =====================
@@ -649,36 +839,82 @@ def aggregate_session_data(conn, user_id: int, start_ts: str, stop_ts: str, mach
         
         return payload
 
-    except Exception as e:
-        print(f"[WARN] aggregate_session_data failed, returning dummy data: {str(e)}")
-        # Return dummy data on any error
-        try:
-            duration_sec = 60.0  # Default fallback
-            return {
-                "machine_id": machine_id or "unknown",
-                "device_id": device_id or "unknown",
-                "session": {
-                    "start": start_ts,
-                    "stop": stop_ts,
-                    "duration_sec": duration_sec
-                },
-                "sound_summary": {
-                    "data_mode": "none",
-                    "dominant_freq_median": 0,
-                    "freq_iqr": [0, 0],
-                    "out_of_profile_events": 0
-                },
-                "vibration_summary": {"avg": 0, "peak": 0, "event_count": 0},
-                "gas_summary": {"avg_raw": 0, "peak_raw": 0, "status": "LOW"}
-            }
-        except Exception as fallback_e:
-            print(f"[ERROR] Failed to create fallback payload: {fallback_e}")
-            raise e  # Re-raise original error if fallback fails
+    except Exception:
+        # Still answer with the zeroed payload, but keep the traceback: a pool or
+        # query failure must not be indistinguishable from an empty session
+        logger.exception(
+            "aggregate_session_data failed for user_id=%s range=%s..%s, returning fallback payload",
+            user_id, start_ts, stop_ts
+        )
+        return _fallback_payload(start_ts, stop_ts, machine_id, device_id)
     finally:
-        try:
-            cursor.close()
-        except:
-            pass  # Ignore cursor close errors
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass  # Ignore cursor close errors
+
+
+# The session aggregates are PREPAREd once per pooled connection (see
+# app.db.prepare), one statement per optional-filter shape.
+_SOUND_AGG_SQL = """
+    WITH base AS (
+        SELECT dominant_freq, machine_id, mode
+        FROM raw_audio
+        WHERE user_id = $1
+          AND timestamp BETWEEN $2 AND $3
+          AND dominant_freq > 0
+          AND mode IN ('live', 'calibration'){machine_filter}
+    ), s AS (
+        SELECT dominant_freq, machine_id, mode
+        FROM base
+        WHERE mode = CASE WHEN EXISTS (SELECT 1 FROM base WHERE mode = 'live')
+                          THEN 'live' ELSE 'calibration' END
+    ), agg AS (
+        SELECT
+            COUNT(*) AS n,
+            MIN(mode) AS data_mode,
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY dominant_freq) AS median,
+            percentile_cont(0.25) WITHIN GROUP (ORDER BY dominant_freq) AS q1,
+            percentile_cont(0.75) WITHIN GROUP (ORDER BY dominant_freq) AS q3,
+            {detected_machine_id} AS detected_machine_id
+        FROM s
+    )
+    SELECT
+        agg.n, agg.data_mode, agg.median, agg.q1, agg.q3, agg.detected_machine_id,
+        (SELECT COUNT(*)
+         FROM s
+         JOIN machine_profiles p
+           ON p.user_id = $1 AND p.machine_id = agg.detected_machine_id
+         WHERE s.dominant_freq < p.iqr_low OR s.dominant_freq > p.iqr_high)
+    FROM agg
+"""
+_SOUND_AGG_STMTS = {
+    False: ("session_sound_agg_stmt", ["int4", "timestamp", "timestamp"],
+            _SOUND_AGG_SQL.format(machine_filter="", detected_machine_id="MAX(machine_id)")),
+    True: ("session_sound_agg_machine_stmt", ["int4", "timestamp", "timestamp", "varchar"],
+           _SOUND_AGG_SQL.format(machine_filter=" AND machine_id = $4", detected_machine_id="$4")),
+}
+
+_ESP32_AGG_SQL = """
+    SELECT
+        COUNT(*),
+        COALESCE(AVG(vibration), 0),
+        COALESCE(MAX(vibration), 0),
+        COUNT(*) FILTER (WHERE vibration > 0),
+        COALESCE(AVG(gas_raw), 0),
+        COALESCE(MAX(gas_raw), 0),
+        MAX(device_id),
+        array_agg(DISTINCT gas_status) FILTER (WHERE gas_status IS NOT NULL)
+    FROM esp32_data
+    WHERE user_id = $1 AND timestamp BETWEEN $2 AND $3{device_filter}
+"""
+_ESP32_AGG_STMTS = {
+    False: ("session_esp32_agg_stmt", ["int4", "timestamp", "timestamp"],
+            _ESP32_AGG_SQL.format(device_filter="")),
+    True: ("session_esp32_agg_device_stmt", ["int4", "timestamp", "timestamp", "varchar"],
+           _ESP32_AGG_SQL.format(device_filter=" AND device_id = $4")),
+}
 
 
 def aggregate_sound_data(cursor, user_id: int, start_ts: str, stop_ts: str, machine_id: str, conn):
@@ -691,35 +927,20 @@ def aggregate_sound_data(cursor, user_id: int, start_ts: str, stop_ts: str, mach
     2. Fallback to CALIBRATION data if no live data exists
     3. Data modes are NEVER mixed
     """
-    def fetch(mode):
-        q = """
-            SELECT dominant_freq, freq_confidence, machine_id
-            FROM raw_audio
-            WHERE user_id = %s
-              AND timestamp BETWEEN %s AND %s
-              AND dominant_freq IS NOT NULL
-              AND dominant_freq > 0
-              AND mode = %s
-        """
-        params = [user_id, start_ts, stop_ts, mode]
-        if machine_id:
-            q += " AND machine_id = %s"
-            params.append(machine_id)
-        q += " ORDER BY timestamp"
-        cursor.execute(q, params)
-        return cursor.fetchall()
-
-    # 1. Try LIVE first
-    rows = fetch("live")
-    data_mode = "live"
-
-    # 2. Fallback to CALIBRATION if no live data
-    if not rows:
-        rows = fetch("calibration")
-        data_mode = "calibration"
-
-    # 3. No data at all
-    if not rows:
+    # One round-trip: rows of the window are scanned once, LIVE rows are used
+    # when there are any, otherwise CALIBRATION rows. Percentiles and the
+    # out-of-profile count are computed server-side, so one row of scalars
+    # comes back instead of every frequency in the window.
+    name, argtypes, sql = _SOUND_AGG_STMTS[bool(machine_id)]
+    prepare(conn, name, argtypes, sql)
+    params = [user_id, start_ts, stop_ts]
+    if machine_id:
+        params.append(machine_id)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    row = cursor.fetchone()
+
+    # No data at all
+    if not row[0]:
         return {
             "data_mode": "none",
             "dominant_freq_median": 0,
@@ -728,96 +949,35 @@ def aggregate_sound_data(cursor, user_id: int, start_ts: str, stop_ts: str, mach
             "detected_machine_id": machine_id
         }
 
-    # Extract frequencies
-    frequencies = [r[0] for r in rows if r[0] and r[0] > 0]
-    
-    # Detect machine_id if not provided
-    detected_machine_id = machine_id or max(
-        (r[2] for r in rows if r[2]), default=None
-    )
-
-    if not frequencies:
-        return {
-            "data_mode": data_mode,
-            "dominant_freq_median": 0,
-            "freq_iqr": [0, 0],
-            "out_of_profile_events": 0,
-            "detected_machine_id": detected_machine_id
-        }
-
-    # Sort for percentile calculations
-    frequencies.sort()
-    n = len(frequencies)
-
-    # Compute median
-    median = (
-        frequencies[n // 2]
-        if n % 2
-        else (frequencies[n // 2 - 1] + frequencies[n // 2]) / 2
-    )
-
-    # Compute IQR (25th and 75th percentiles)
-    q1 = frequencies[int(0.25 * (n - 1))]
-    q3 = frequencies[int(0.75 * (n - 1))]
-
-    # Only compare against profiles in LIVE mode (calibration IS the profile)
-    out_of_profile = (
-        count_out_of_profile_events(conn, user_id, frequencies, detected_machine_id)
-        if data_mode == "live" and detected_machine_id
-        else 0
-    )
+    _, data_mode, median, q1, q3, detected_machine_id, out_of_profile = row
 
     return {
         "data_mode": data_mode,
         "dominant_freq_median": round(median, 2),
         "freq_iqr": [round(q1, 2), round(q3, 2)],
-        "out_of_profile_events": out_of_profile,
+        # Only compare against profiles in LIVE mode (calibration IS the profile)
+        "out_of_profile_events": out_of_profile if data_mode == "live" else 0,
         "detected_machine_id": detected_machine_id
     }
 
 
-def count_out_of_profile_events(conn, user_id: int, frequencies: list, machine_id: str) -> int:
-    """
-    Count how many frequency readings fall outside the machine's calibrated IQR range.
-    """
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT iqr_low, iqr_high FROM machine_profiles WHERE machine_id = %s AND user_id = %s",
-            (machine_id, user_id)
-        )
-        row = cursor.fetchone()
-        
-        if not row:
-            return 0
-        
-        iqr_low, iqr_high = row
-        out_of_range = sum(1 for f in frequencies if f < iqr_low or f > iqr_high)
-        return out_of_range
-        
-    finally:
-        cursor.close()
-
-
 def aggregate_esp32_data(cursor, user_id: int, start_ts: str, stop_ts: str, device_id: str = None):
     """
     Aggregate ESP32 sensor data (vibration + gas) for a user.
     """
-    # Build query with optional device_id filter
-    q = """
-        SELECT vibration, gas_raw, device_id, gas_status
-        FROM esp32_data
-        WHERE timestamp BETWEEN %s AND %s
-    """
-    params = [start_ts, stop_ts]
+    # One aggregate row instead of every reading: NULLs are skipped by
+    # AVG/MAX exactly as the old per-row filtering did
+    name, argtypes, sql = _ESP32_AGG_STMTS[bool(device_id)]
+    prepare(cursor.connection, name, argtypes, sql)
+    params = [user_id, start_ts, stop_ts]
     if device_id:
-        q += " AND device_id = %s"
         params.append(device_id)
         
-    cursor.execute(q, params)
-    rows = cursor.fetchall()
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    (row_count, vib_avg, vib_peak, vib_events,
+     gas_avg, gas_peak, max_device_id, gas_statuses) = cursor.fetchone()
     
-    if not rows:
+    if not row_count:
         return (
             {"avg": 0, "peak": 0, "event_count": 0},
             {"avg_raw": 0, "peak_raw": 0, "status": "NO_DATA"},
@@ -825,35 +985,16 @@ def aggregate_esp32_data(cursor, user_id: int, start_ts: str, stop_ts: str, devi
         )
         
     # Detect device_id if missing
-    resolved_device_id = device_id or max(
-        (r[2] for r in rows if r[2]), default=None
-    )
+    resolved_device_id = device_id or max_device_id
     
-    # Process Vibration
-    vibrations = [r[0] for r in rows if r[0] is not None]
-    if vibrations:
-        vib_avg = sum(vibrations) / len(vibrations)
-        vib_peak = max(vibrations)
-        vib_events = sum(1 for v in vibrations if v > 0) # Assumes >0 is event
-    else:
-        vib_avg, vib_peak, vib_events = 0, 0, 0
-        
     vibration_summary = {
         "avg": round(vib_avg, 2),
         "peak": round(vib_peak, 2),
-        "event_count": vib_events
+        "event_count": vib_events  # Assumes >0 is event
     }
     
-    # Process Gas
-    gas_raws = [r[1] for r in rows if r[1] is not None]
-    gas_statuses = [r[3] for r in rows if r[3] is not None]
-
-    # Gas summary
-    gas_avg = sum(gas_raws) / len(gas_raws) if gas_raws else 0
-    gas_peak = max(gas_raws) if gas_raws else 0
-    
     # Determine overall gas status
-    gas_status = determine_gas_status(gas_avg, gas_statuses)
+    gas_status = determine_gas_status(gas_avg, gas_statuses or [])
     
     gas_summary = {
         "avg_raw": round(gas_avg, 1),
@@ -864,21 +1005,23 @@ def aggregate_esp32_data(cursor, user_id: int, start_ts: str, stop_ts: str, devi
     return vibration_summary, gas_summary, resolved_device_id
 
 
+# Any of these reported by a sensor marks the whole session HIGH
+_HAZARD_STATUSES = frozenset({'DANGER', 'RISK', 'HAZARDOUS'})
+# Average gas_raw tiers: > 800 is MEDIUM, > 2000 is HIGH
+_GAS_THRESHOLDS = (800, 2000)
+_GAS_LABELS = ("LOW", "MEDIUM", "HIGH")
+
+
 def determine_gas_status(avg_gas: float, statuses: list) -> str:
     """
     Determine overall gas status based on average value and collected statuses.
     """
     # Priority: if any DANGER/RISK, mark HIGH
-    if any(s in ['DANGER', 'RISK', 'HAZARDOUS'] for s in statuses):
+    if not _HAZARD_STATUSES.isdisjoint(statuses):
         return "HIGH"
     
-    # By average value thresholds
-    if avg_gas > 2000:
-        return "HIGH"
-    elif avg_gas > 800:
-        return "MEDIUM"
-    else:
-        return "LOW"
+    # By average value thresholds (bisect_left keeps the boundaries exclusive)
+    return _GAS_LABELS[bisect_left(_GAS_THRESHOLDS, avg_gas)]
 
 
 def get_gemini_api_key_status() -> dict:
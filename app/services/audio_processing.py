@@ -1,6 +1,9 @@
 import math
+import numpy as np
 import os
-from app.db import get_db
+from threading import Lock
+from cachetools import TTLCache
+from app.db import readonly_db
 
 # Configurable limits
 IQR_LIMIT = None
@@ -15,17 +18,38 @@ except Exception:
 AMPLITUDE_THRESHOLD = 0.02  # Capture background sounds (lowered from 0.1)
 CONFIDENCE_THRESHOLD = 0.1  # Lower FFT confidence requirement for quieter sounds
 
+
+def audible_frame_indices(frames):
+    """
+    Indices of the frames at or above AMPLITUDE_THRESHOLD that carry at least
+    one peak, computed as one vectorized mask instead of a branch per frame.
+    """
+    n = len(frames)
+    amps = np.fromiter((f.get('amplitude') for f in frames), dtype=np.float64, count=n)
+    peak_lens = np.fromiter((len(f.get('peaks', ())) for f in frames), dtype=np.intp, count=n)
+    # ~(amps < T) rather than amps >= T so NaN amplitudes are kept, as before
+    return np.flatnonzero(~(amps < AMPLITUDE_THRESHOLD) & (peak_lens > 0)).tolist()
+
 # =========================
 # ONLINE ML MODEL (EWMA for anomaly)
 # =========================
+# update_batch() solves the EWMA recurrences in blocks of this many samples
+NOISE_BATCH_BLOCK = 256
+
 class NoiseModel:
     def __init__(self, alpha=0.02):
         self.alpha = alpha
         self.expected_noise = None
         self.variance = None
         self.initialized = False
+        # Request threads and the sharded batch workers share one model
+        self._lock = Lock()
 
     def update(self, amplitude):
+        with self._lock:
+            return self._update(amplitude)
+
+    def _update(self, amplitude):
         if not self.initialized:
             self.expected_noise = amplitude
             self.variance = 1.0
@@ -42,6 +66,44 @@ class NoiseModel:
         anomaly = z_score >= 3.0
         return z_score, anomaly
 
+    def update_batch(self, amplitudes):
+        """
+        Equivalent to calling update() on each amplitude in order.
+
+        Both the mean and the variance are first-order linear recurrences, so
+        each block is solved with cumulative sums scaled by powers of
+        (1 - alpha). Blocks are kept short so those powers stay in range.
+
+        Returns:
+            (z_scores, anomalies) as NumPy arrays
+        """
+        x = np.asarray(amplitudes, dtype=np.float64)
+        z_scores = np.zeros(len(x))
+        start = 0
+        with self._lock:
+            if len(x) and not self.initialized:
+                self._update(float(x[0]))
+                start = 1
+            for i in range(start, len(x), NOISE_BATCH_BLOCK):
+                block = x[i:i + NOISE_BATCH_BLOCK]
+                z_scores[i:i + len(block)] = self._update_block(block)
+        return z_scores, z_scores >= 3.0
+
+    def _update_block(self, x):
+        decay = 1.0 - self.alpha
+        powers = decay ** np.arange(1, len(x) + 1)
+
+        means = powers * (self.expected_noise + self.alpha * np.cumsum(x / powers))
+        prev_means = np.concatenate(([self.expected_noise], means[:-1]))
+        diff = x - prev_means
+        variances = powers * (self.variance + self.alpha * np.cumsum(diff ** 2 / powers))
+
+        self.expected_noise = float(means[-1])
+        self.variance = float(variances[-1])
+
+        std = np.sqrt(np.where(variances > 0, variances, 1.0))
+        return np.abs(diff) / std
+
 noise_model = NoiseModel()
 
 # =========================
@@ -52,6 +114,123 @@ MIN_PEAK_AMP = 0.15
 # Minimum number of frequency bands that must match for detection
 MIN_BAND_MATCHES = 2
 
+class _ProfileMatcher:
+    """
+    One user's profiles flattened into NumPy arrays for per-frame matching.
+
+    Every frequency band of every band-profile becomes one row of
+    band_low/band_high (band_machine maps it back to its profile);
+    IQR-only profiles get their own low/high arrays.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.machine_ids = [row[0] for row in profiles]
+
+        band_low, band_high, band_machine = [], [], []
+        iqr_low, iqr_high, iqr_machine = [], [], []
+        has_bands = np.zeros(len(profiles), dtype=bool)
+        for idx, (machine_id, freq_bands, low, high) in enumerate(profiles):
+            if freq_bands and len(freq_bands) > 0:
+                has_bands[idx] = True
+                for band in freq_bands:
+                    band_low.append(band.get("low", 0))
+                    band_high.append(band.get("high", 0))
+                    band_machine.append(idx)
+            elif low is not None and high is not None:
+                iqr_low.append(low)
+                iqr_high.append(high)
+                iqr_machine.append(idx)
+
+        self.has_bands = has_bands
+        self.band_low = np.array(band_low, dtype=np.float64)[:, None]
+        self.band_high = np.array(band_high, dtype=np.float64)[:, None]
+        self.band_machine = np.array(band_machine, dtype=np.intp)
+        self.band_rows = np.arange(len(band_machine))
+        self.iqr_low = np.array(iqr_low, dtype=np.float64)[:, None]
+        self.iqr_high = np.array(iqr_high, dtype=np.float64)[:, None]
+        self.iqr_machine = np.array(iqr_machine, dtype=np.intp)
+
+    def match(self, peaks_list, detected_machines, anomaly_machines):
+        n = len(peaks_list)
+        freqs = np.fromiter((peak.get("freq") or 0 for peak in peaks_list), np.float64, n)
+        amps = np.fromiter((peak.get("amp", 0) or 0 for peak in peaks_list), np.float64, n)
+        freqs = freqs[(freqs > 0) & (amps >= MIN_PEAK_AMP)][None, :]
+        if not freqs.size:
+            return
+
+        if len(self.band_machine):
+            low, high = self.band_low, self.band_high
+            in_band = (low <= freqs) & (freqs <= high)
+            near_band = ((low - 10 <= freqs) & (freqs < low - 5)) | ((high + 5 < freqs) & (freqs <= high + 10))
+            # Each band is decided by the first peak that lands in or near it
+            hit = in_band | near_band
+            first = hit.argmax(axis=1)
+            decided = hit[self.band_rows, first]
+            matched = decided & in_band[self.band_rows, first]
+            n_machines = len(self.machine_ids)
+            match_count = np.bincount(self.band_machine[matched], minlength=n_machines)
+            anomaly_count = np.bincount(self.band_machine[decided & ~matched], minlength=n_machines)
+            is_detected = self.has_bands & (match_count >= MIN_BAND_MATCHES)
+            is_anomaly = self.has_bands & ~is_detected & (anomaly_count >= MIN_BAND_MATCHES)
+            detected_machines.update(self.machine_ids[i] for i in np.flatnonzero(is_detected))
+            anomaly_machines.update(self.machine_ids[i] for i in np.flatnonzero(is_anomaly))
+
+        if len(self.iqr_machine):
+            low, high = self.iqr_low, self.iqr_high
+            normal = ((low <= freqs) & (freqs <= high)).any(axis=1)
+            near = (((low - 10 <= freqs) & (freqs < low - 5)) | ((high + 5 < freqs) & (freqs <= high + 10))).any(axis=1)
+            detected_machines.update(self.machine_ids[i] for i in self.iqr_machine[normal])
+            anomaly_machines.update(self.machine_ids[i] for i in self.iqr_machine[~normal & near])
+
+# Profiles change only when a user saves or deletes one, so the per-frame
+# matcher reads them from a short-lived per-user cache instead of the database.
+PROFILE_CACHE_TTL = 5
+_profile_cache = TTLCache(maxsize=1024, ttl=PROFILE_CACHE_TTL)
+_profile_cache_lock = Lock()
+
+def invalidate_profiles(user_id=None):
+    """Drop cached profiles for one user (or everyone) after they change.
+
+    Takes effect immediately in this process; other worker processes pick
+    the change up within PROFILE_CACHE_TTL.
+    """
+    with _profile_cache_lock:
+        if user_id is None:
+            _profile_cache.clear()
+        else:
+            _profile_cache.pop(user_id, None)
+
+def _get_matcher(user_id):
+    """Return the cached _ProfileMatcher for a user, loading profiles on a miss."""
+    with _profile_cache_lock:
+        matcher = _profile_cache.get(user_id)
+    if matcher is not None:
+        return matcher
+
+    with readonly_db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT machine_id, freq_bands, iqr_low, iqr_high FROM machine_profiles WHERE user_id = %s ORDER BY machine_id",
+                (user_id,)
+            )
+            matcher = _ProfileMatcher(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    with _profile_cache_lock:
+        _profile_cache[user_id] = matcher
+    return matcher
+
+def get_user_profiles(user_id):
+    """Return (machine_id, freq_bands, iqr_low, iqr_high) rows for a user, cached briefly."""
+    return _get_matcher(user_id).profiles
+
+def get_all_machines(user_id):
+    """Machine ids with a saved profile for this user, served from the profile cache."""
+    return list(_get_matcher(user_id).machine_ids)
+
 def identify_machines(user_id, peaks_list):
     """
     Match detected peaks to machine profiles for a SPECIFIC USER.
@@ -67,63 +246,31 @@ def identify_machines(user_id, peaks_list):
     if not peaks_list or len(peaks_list) == 0:
         return {"detected": [], "anomaly": []}
 
-    conn = get_db()
-    if conn is None:
+    matcher = _get_matcher(user_id)
+    if not matcher.profiles:
         return {"detected": [], "anomaly": []}
-        
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT machine_id, freq_bands, iqr_low, iqr_high FROM machine_profiles WHERE user_id = %s ORDER BY machine_id",
-            (user_id,)
-        )
-        profiles = cursor.fetchall()
-        if not profiles:
-            return {"detected": [], "anomaly": []}
-
-        detected_machines = set()
-        anomaly_machines = set()
-
-        for machine_id, freq_bands, iqr_low, iqr_high in profiles:
-            if freq_bands and len(freq_bands) > 0:
-                match_count = 0
-                anomaly_count = 0
-                for band in freq_bands:
-                    band_low = band.get("low", 0)
-                    band_high = band.get("high", 0)
-                    for peak in peaks_list:
-                        freq = peak.get("freq")
-                        amp = peak.get("amp", 0)
-                        if not freq or freq <= 0 or amp < MIN_PEAK_AMP:
-                            continue
-                        if band_low <= freq <= band_high:
-                            match_count += 1
-                            break
-                        # Check for anomaly: within 5-10Hz outside the band
-                        elif (band_low - 10 <= freq < band_low - 5) or (band_high + 5 < freq <= band_high + 10):
-                            anomaly_count += 1
-                            break
-                if match_count >= MIN_BAND_MATCHES:
-                    detected_machines.add(machine_id)
-                elif anomaly_count >= MIN_BAND_MATCHES:
-                    anomaly_machines.add(machine_id)
-            elif iqr_low is not None and iqr_high is not None:
-                normal = False
-                anomaly = False
-                for peak in peaks_list:
-                    freq = peak.get("freq")
-                    amp = peak.get("amp", 0)
-                    if not freq or freq <= 0 or amp < MIN_PEAK_AMP:
-                        continue
-                    if iqr_low <= freq <= iqr_high:
-                        normal = True
-                    elif (iqr_low - 10 <= freq < iqr_low - 5) or (iqr_high + 5 < freq <= iqr_high + 10):
-                        anomaly = True
-                if normal:
-                    detected_machines.add(machine_id)
-                elif anomaly:
-                    anomaly_machines.add(machine_id)
-
-        return {"detected": list(detected_machines), "anomaly": list(anomaly_machines)}
-    finally:
-        cursor.close()
+
+    detected_machines = set()
+    anomaly_machines = set()
+    matcher.match(peaks_list, detected_machines, anomaly_machines)
+
+    return {"detected": list(detected_machines), "anomaly": list(anomaly_machines)}
+
+def identify_machines_batch(user_id, frames_peaks):
+    """
+    Same matching as identify_machines, over many frames at once.
+
+    Each frame is still matched on its own (bands must match within a frame);
+    the result is the union across frames, as the ingest paths accumulate it.
+    """
+    matcher = _get_matcher(user_id) if frames_peaks else None
+    if not matcher or not matcher.profiles:
+        return {"detected": [], "anomaly": []}
+
+    detected_machines = set()
+    anomaly_machines = set()
+    for peaks_list in frames_peaks:
+        if peaks_list:
+            matcher.match(peaks_list, detected_machines, anomaly_machines)
+
+    return {"detected": list(detected_machines), "anomaly": list(anomaly_machines)}
@@ -1,174 +1,411 @@
+import itertools
+import logging
 import queue
 import os
 import time
 import json
+import orjson
 import threading
-import traceback
-from datetime import datetime
-import psycopg2.extras
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from app.db import get_db
-from app.services.audio_processing import AMPLITUDE_THRESHOLD, noise_model, identify_machines
+from app.services.raw_audio_writer import insert_raw_audio
+from app.services.audio_processing import audible_frame_indices, noise_model, identify_machines_batch, get_all_machines
 from app.services.stability import update_detection_history, get_stable_machines
 
+logger = logging.getLogger(__name__)
+
 # =========================
 # BATCH QUEUE FOR ASYNC PROCESSING
 # =========================
-# Queue to hold incoming large payloads so the HTTP response can return quickly
-BATCH_QUEUE = queue.Queue()
+class BatchQueue:
+    """
+    Many-producer / single-consumer FIFO for the batch worker.
+
+    deque.append and deque.popleft are atomic, so producers never take a lock;
+    a single Event only wakes the consumer when it finds the deque empty.
+    Exposes the subset of queue.Queue used here: put_nowait, get, get_nowait
+    and qsize.
+    """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._ready = threading.Event()
+
+    def put_nowait(self, item):
+        if self.maxsize and len(self._items) >= self.maxsize:
+            raise queue.Full
+        self._items.append(item)
+        self._ready.set()
+
+    def get(self):
+        while True:
+            try:
+                return self._items.popleft()
+            except IndexError:
+                pass
+            # Clear before re-checking so a put between the two can't be missed
+            self._ready.clear()
+            if not self._items:
+                self._ready.wait()
+
+    def get_nowait(self):
+        try:
+            return self._items.popleft()
+        except IndexError:
+            raise queue.Empty from None
+
+    def qsize(self):
+        return len(self._items)
+
+# Queues to hold incoming large payloads so the HTTP response can return quickly
+# Items are (user_id, raw_json_bytes); parsing is left to the worker threads.
+# Batches are sharded by user: one user's batches stay in order on one worker,
+# while different users' batches are written in parallel.
+BATCH_WORKERS = max(1, int(os.getenv('BATCH_WORKERS', '4')))
+BATCH_QUEUES = [BatchQueue() for _ in range(BATCH_WORKERS)]
+# The queue is bounded by total payload bytes rather than item count
+BATCH_QUEUE_MAX_BYTES = int(os.getenv('BATCH_QUEUE_MAX_BYTES', str(256 * 1024 * 1024)))
+_queued_bytes = 0
+_queued_bytes_lock = threading.Lock()
+# Batches already waiting when the worker wakes are written together, up to this many
+BATCH_DRAIN_MAX = 16
+# With async commit on, the worker's COMMIT returns without waiting for the WAL
+# flush. Off by default: a server crash can lose the last few hundred ms of
+# acknowledged batches (never corrupts them).
+BATCH_ASYNC_COMMIT = os.getenv('BATCH_ASYNC_COMMIT', '0') == '1'
+# A worker keeps adding drained groups to one transaction until it holds this
+# many rows or is this many seconds old; it always commits before the queue
+# runs dry, so a quiet shard never sits on uncommitted batches.
+BATCH_COMMIT_ROWS = int(os.getenv('BATCH_COMMIT_ROWS', '2000'))
+BATCH_COMMIT_INTERVAL = float(os.getenv('BATCH_COMMIT_INTERVAL', '0.2'))
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FAILED_BATCH_DIR = os.path.join(os.path.dirname(BASE_DIR), 'data', 'failed_batches') # app/../data/failed_batches
 os.makedirs(FAILED_BATCH_DIR, exist_ok=True)
+_failed_seq = itertools.count()
+# Single writer thread for failed batches; pending writes finish at interpreter exit
+_persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist-failed")
+
+
+def _shard_for(user_id):
+    return BATCH_QUEUES[hash(user_id) % len(BATCH_QUEUES)]
+
+
+def queued_batches():
+    """Number of batches waiting across all shards."""
+    return sum(q.qsize() for q in BATCH_QUEUES)
+
+
+def enqueue_batch(user_id, raw):
+    """Queue a raw JSON batch for the worker. Raises queue.Full past the byte budget."""
+    global _queued_bytes
+    size = len(raw)
+    with _queued_bytes_lock:
+        if _queued_bytes + size > BATCH_QUEUE_MAX_BYTES:
+            raise queue.Full
+        _queued_bytes += size
+    _shard_for(user_id).put_nowait((user_id, raw))
+
+
+def accept_batch(user_id, raw):
+    """Validate and queue a raw /ingest_batch body. Returns (response_body, status)."""
+    # Parsing happens on the worker thread; only a cheap shape check here
+    if not raw or b'"frames"' not in raw:
+        return {"error": "frames required"}, 400
+
+    try:
+        enqueue_batch(user_id, raw)
+        return {"status": "accepted", "queue_size": queued_batches()}, 202
+    except queue.Full:
+        try:
+            payload = orjson.loads(raw)
+            payload['user_id'] = user_id
+        except Exception:
+            payload = raw
+        persist_failed_batch(payload)
+        return {"error": "queue full, persisted"}, 503
+
+
+def _release_bytes(size):
+    global _queued_bytes
+    with _queued_bytes_lock:
+        _queued_bytes -= size
 
 
 def persist_failed_batch(payload):
+    """
+    Queue a batch to be written to FAILED_BATCH_DIR; accepts a parsed dict or
+    raw JSON bytes. The write happens on a dedicated thread so a burst of
+    failures never stalls the batch workers on disk I/O.
+    """
     try:
         ts = int(time.time() * 1000)
-        path = os.path.join(FAILED_BATCH_DIR, f'failed_{ts}.json')
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(payload, f)
-        print(f"[WARN] Persisted failed batch to {path}")
+        # Several batches of one drained group can fail within the same millisecond
+        path = os.path.join(FAILED_BATCH_DIR, f'failed_{ts}_{next(_failed_seq)}.json')
+        if isinstance(payload, (bytes, bytearray)):
+            blob = bytes(payload)
+        else:
+            try:
+                blob = orjson.dumps(payload)
+            except TypeError:  # e.g. integers beyond 64 bits
+                blob = json.dumps(payload).encode('utf-8')
+        _persist_executor.submit(_write_failed_batch, path, blob)
     except Exception as e:
-        print("[ERROR] Failed to persist batch:", str(e))
+        logger.error("Failed to persist batch: %s", e)
 
 
-def batch_worker():
-    """Background worker to process queued batches."""
-    conn = get_db()
-    
-    while True:
-        batch = BATCH_QUEUE.get()
-        if batch is None:
-            break
+def _write_failed_batch(path, blob):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            view = memoryview(blob)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        logger.warning("Persisted failed batch to %s", path)
+    except Exception as e:
+        logger.error("Failed to persist batch: %s", e)
+
+
+def _batch_rows(user_id, batch):
+    """
+    Validate one decoded batch and turn its frames into raw_audio rows.
+
+    Returns (rows, live_amps, running_machines), or None when the batch is
+    skipped. live_amps/running_machines are None for calibration batches.
+    """
+    mode = batch.get('mode', 'live')
+
+    if not user_id:
+        logger.warning("Skipping batch missing user_id")
+        return None
+
+    if mode == 'calibration':
+        frames = batch.get('frames', [])
+        machine_id = batch.get('machine_id')
+
+        if not frames or not machine_id:
+            logger.warning("Skipping invalid calibration batch (missing fields)")
+            return None
+    elif mode == 'live':
+        frames = batch.get('frames', [])
+        machine_id = None
+        if not frames:
+            logger.warning("Skipping empty live batch")
+            return None
+    else:
+        logger.warning("Unknown batch mode: %s", mode)
+        return None
+
+    live = mode == 'live'
+    rows = []
+    live_amps = [] if live else None
+    live_peaks = []
 
+    # Silent frames are masked out up front; live amplitudes are scored afterwards in one
+    # vectorized EWMA update, and live peaks matched in one batch call
+    for i in audible_frame_indices(frames):
+        frame = frames[i]
+        amplitude = frame.get('amplitude')
+        peaks = frame.get('peaks', [])
+        timestamp = frame.get('timestamp')
+
+        rows.append((
+            timestamp / 1000 if timestamp else None,
+            amplitude,
+            peaks[0].get('freq'),
+            peaks[0].get('amp'),
+            orjson.dumps(peaks).decode(),
+            machine_id,
+            mode,
+            user_id
+        ))
+
+        if live:
+            live_amps.append(amplitude)
+            live_peaks.append(peaks)
+
+    running_machines = None
+    if live:
+        # Profiles are loaded once for the whole batch; each frame is still matched on its own
+        running_machines = set(identify_machines_batch(user_id, live_peaks)["detected"])
+
+    return rows, live_amps, running_machines
+
+
+def _decode_batches(items):
+    """
+    Decode a group of queued (user_id, raw) batches into rows.
+
+    Returns [(user_id, batch, rows, live_amps, running_machines)] for the
+    batches worth writing; undecodable batches are persisted right away.
+    """
+    accepted = []
+    for user_id, raw in items:
+        _release_bytes(len(raw))
+        batch = None
         try:
-            # Reuse ingest logic but in worker context (create fresh cursor)
-            mode = batch.get('mode', 'live')
-            user_id = batch.get('user_id') # REQUIRED
+            batch = orjson.loads(raw)
+            # Kept on the dict so a persisted failure still records its owner
+            batch['user_id'] = user_id
+            result = _batch_rows(user_id, batch)
+            if result is not None:
+                accepted.append((user_id, batch, *result))
+        except Exception as e:
+            logger.exception("Batch worker error: %s", e)
+            persist_failed_batch(batch if batch is not None else raw)
+    return accepted
 
-            if not user_id:
-                print('[WARN] Skipping batch missing user_id')
-                continue
 
-            if mode == 'calibration':
-                frames = batch.get('frames', [])
-                frames_captured = batch.get('frames_captured', len(frames))
-                machine_id = batch.get('machine_id')
+class _WorkerTransaction:
+    """
+    The batch worker's open transaction, spanning as many drained groups as
+    the commit thresholds allow so one WAL flush covers all of them.
 
-                if not frames or not machine_id:
-                    print('[WARN] Skipping invalid calibration batch (missing fields)')
-                    continue
+    Stability updates for a batch run only once its rows are committed; if
+    the INSERT or the COMMIT fails, every batch of the transaction is
+    persisted to FAILED_BATCH_DIR.
+    """
 
-                cursor = conn.cursor()
-                inserted_count = 0
-                for frame in frames:
-                    amplitude = frame.get('amplitude')
-                    peaks = frame.get('peaks', [])
-                    timestamp = frame.get('timestamp')
-
-                    if amplitude < AMPLITUDE_THRESHOLD or len(peaks) == 0:
-                        continue
-
-                    dominant_freq = peaks[0].get('freq') if len(peaks) > 0 else None
-                    freq_confidence = peaks[0].get('amp') if len(peaks) > 0 else None
-
-                    cursor.execute(
-                        """
-                        INSERT INTO raw_audio
-                        (timestamp, amplitude, dominant_freq, freq_confidence, peaks, machine_id, mode, user_id)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        """,
-                        (
-                            datetime.fromtimestamp(timestamp / 1000),
-                            amplitude,
-                            dominant_freq,
-                            freq_confidence,
-                            psycopg2.extras.Json(peaks),
-                            machine_id,
-                            mode,
-                            user_id
-                        )
-                    )
-                    inserted_count += 1
+    def __init__(self, conn, cursor):
+        self.conn = conn
+        self.cursor = cursor
+        self.pending = []  # accepted batches written but not yet committed
+        self.rows = 0
+        self.started = None
 
-                conn.commit()
-                cursor.close()
-                print(f"\n[OK] (worker) CALIBRATION BATCH: {machine_id} inserted: {inserted_count} (captured={frames_captured})")
+    def write(self, accepted):
+        try:
+            for _, _, _, live_amps, _ in accepted:
+                if live_amps:
+                    noise_model.update_batch(live_amps)
 
-            elif mode == 'live':
-                frames = batch.get('frames', [])
-                frames_captured = batch.get('frames_captured', len(frames))
-                if not frames:
-                    print('[WARN] Skipping empty live batch')
-                    continue
+            if not self.pending:
+                self.started = time.monotonic()
+                if BATCH_ASYNC_COMMIT:
+                    self.cursor.execute("SET LOCAL synchronous_commit TO OFF")
+            all_rows = [row for _, _, rows, _, _ in accepted for row in rows]
+            if all_rows:
+                insert_raw_audio(self.cursor, all_rows)
+        except Exception as e:
+            logger.exception("Batch worker error: %s", e)
+            self._fail(accepted)
+            return
+        self.pending.extend(accepted)
+        self.rows += len(all_rows)
 
-                cursor = conn.cursor()
-                inserted_count = 0
-                running_machines = set()
-
-                for frame in frames:
-                    amplitude = frame.get('amplitude')
-                    peaks = frame.get('peaks', [])
-                    timestamp = frame.get('timestamp')
-
-                    if amplitude < AMPLITUDE_THRESHOLD or len(peaks) == 0:
-                        continue
-
-                    z_score, anomaly = noise_model.update(amplitude)
-
-                    dominant_freq = peaks[0].get('freq') if len(peaks) > 0 else None
-                    freq_confidence = peaks[0].get('amp') if len(peaks) > 0 else None
-
-                    cursor.execute(
-                        """
-                        INSERT INTO raw_audio
-                        (timestamp, amplitude, dominant_freq, freq_confidence, peaks, machine_id, mode, user_id)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        """,
-                        (
-                            datetime.fromtimestamp(timestamp / 1000),
-                            amplitude,
-                            dominant_freq,
-                            freq_confidence,
-                            psycopg2.extras.Json(peaks),
-                            None,
-                            mode,
-                            user_id
-                        )
-                    )
-                    inserted_count += 1
+    def due(self, batch_queue):
+        """Commit once enough rows or time have built up, or nothing else is waiting."""
+        return bool(self.pending) and (
+            self.rows >= BATCH_COMMIT_ROWS
+            or time.monotonic() - self.started >= BATCH_COMMIT_INTERVAL
+            or batch_queue.qsize() == 0
+        )
 
-                    # TODO: Update identify_machines to take user_id
-                    machines_in_frame = identify_machines(user_id, peaks)
-                    running_machines.update(machines_in_frame["detected"]) 
+    def commit(self):
+        if not self.pending:
+            return
+        committed = self.pending
+        try:
+            self.conn.commit()
+        except Exception as e:
+            logger.exception("Batch worker error: %s", e)
+            self._fail([])
+            return
+        self.pending = []
+        self.rows = 0
 
-                conn.commit()
+        try:
+            # Update temporal stability, one history step per batch in queue order
+            for user_id, batch, rows, _, running_machines in committed:
+                if running_machines is None:
+                    logger.debug(
+                        "(worker) CALIBRATION BATCH: %s inserted: %d (captured=%s)",
+                        batch.get('machine_id'), len(rows), batch.get('frames_captured', len(batch['frames']))
+                    )
+                    continue
 
-                # Update temporal stability (fetch all machine ids for THIS user)
-                cursor.execute("SELECT machine_id FROM machine_profiles WHERE user_id = %s", (user_id,))
-                all_machines = [row[0] for row in cursor.fetchall()]
-                
+                # Same cached profiles the batch was just matched against
+                all_machines = get_all_machines(user_id)
                 update_detection_history(user_id, running_machines, all_machines)
                 stable_machines = get_stable_machines(user_id, all_machines)
 
-                cursor.close()
-                print(f"\n[OK] (worker) LIVE BATCH: user={user_id}, {len(frames)} frames, {inserted_count} inserted")
-                print(f"   Detected (raw): {sorted(running_machines)}")
-                print(f"   Stable machines: {sorted(stable_machines)}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "(worker) LIVE BATCH: user=%s, %d frames, %d inserted; detected (raw): %s; stable: %s",
+                        user_id, len(batch['frames']), len(rows), sorted(running_machines), sorted(stable_machines)
+                    )
+        except Exception as e:
+            # The rows are already committed; persisting them would duplicate them
+            logger.exception("Batch worker stability error: %s", e)
+
+    def _fail(self, accepted):
+        for _, batch, _, _, _ in self.pending + accepted:
+            persist_failed_batch(batch)
+        self.pending = []
+        self.rows = 0
+        # Reset the aborted transaction so the same cursor can take the next group
+        if not self.conn.closed:
+            self.conn.rollback()
+
+
+def _next_group(batch_queue):
+    """
+    Block for the next batch and take whatever else is already queued, up to
+    BATCH_DRAIN_MAX. Returns (items, stop); stop is set once the None sentinel
+    has been seen.
+    """
+    item = batch_queue.get()
+    if item is None:
+        return [], True
+
+    # Whatever else is already queued shares this transaction and commit
+    items = [item]
+    while len(items) < BATCH_DRAIN_MAX:
+        try:
+            item = batch_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is None:
+            return items, True
+        items.append(item)
+    return items, False
+
 
-            else:
-                print('[WARN] Unknown batch mode:', mode)
+def batch_worker(batch_queue):
+    """
+    Background worker to process the batches of one queue shard.
 
+    The worker keeps one pooled connection and one cursor for its whole
+    lifetime; it only checks out a new one after the server drops the old.
+    """
+    while True:
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                txn = _WorkerTransaction(conn, cursor)
+                try:
+                    while not conn.closed:
+                        items, stop = _next_group(batch_queue)
+                        accepted = _decode_batches(items)
+                        if accepted:
+                            txn.write(accepted)
+                        # Never block on an empty queue with rows uncommitted
+                        if stop or txn.due(batch_queue):
+                            txn.commit()
+                        if stop:
+                            return
+                finally:
+                    cursor.close()
         except Exception as e:
-            print('[ERROR] Batch worker error:', str(e))
-            traceback.print_exc()
-            try:
-                persist_failed_batch(batch)
-            except Exception:
-                pass
+            logger.error("Batch worker connection error: %s", e)
+            time.sleep(1)
 
-        finally:
-            BATCH_QUEUE.task_done()
 
 def start_worker():
-    worker_thread = threading.Thread(target=batch_worker, daemon=True)
-    worker_thread.start()
+    for shard, batch_queue in enumerate(BATCH_QUEUES):
+        worker_thread = threading.Thread(
+            target=batch_worker, args=(batch_queue,), daemon=True, name=f"batch-worker-{shard}"
+        )
+        worker_thread.start()
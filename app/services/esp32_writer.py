@@ -0,0 +1,111 @@
+import atexit
+import logging
+import os
+import threading
+import psycopg2.extras
+from app.db import get_db
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# ESP32 GROUP COMMIT
+# =========================
+# Sensors push small readings many times a second, and a commit per reading
+# means an fsync per reading. With group commit on, readings are buffered and
+# written in one transaction every GROUP_COMMIT_INTERVAL seconds or
+# GROUP_COMMIT_MAX_ROWS rows, whichever comes first. Off by default: buffered
+# readings are lost if the process dies before the next flush.
+GROUP_COMMIT_ENABLED = os.getenv('ESP32_GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_INTERVAL = 0.05
+GROUP_COMMIT_MAX_ROWS = 100
+
+ESP32_INSERT = """
+    INSERT INTO esp32_data
+    (device_id, timestamp, vibration, event_count, gas_raw, gas_status, user_id)
+    VALUES %s
+"""
+
+_pending = []
+_pending_lock = threading.Lock()
+_flush_now = threading.Event()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def submit_reading(device_id, received_at, vibration, event_count, gas_raw, gas_status, user_id):
+    """Buffer one reading for the next group commit.
+
+    received_at is the request's arrival time, so a reading's time doesn't
+    drift to the flush time.
+    """
+    _ensure_flusher()
+    row = (device_id, received_at, vibration, event_count, gas_raw, gas_status, user_id)
+    with _pending_lock:
+        _pending.append(row)
+        full = len(_pending) >= GROUP_COMMIT_MAX_ROWS
+    if full:
+        _flush_now.set()
+
+
+def flush():
+    """Write every buffered reading in a single transaction."""
+    with _pending_lock:
+        if not _pending:
+            return
+        rows = _pending[:]
+        _pending.clear()
+
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            try:
+                psycopg2.extras.execute_values(cursor, ESP32_INSERT, rows, page_size=500)
+                conn.commit()
+            finally:
+                cursor.close()
+    except Exception as e:
+        # One bad reading must not take the rest of the group down with it
+        logger.warning("ESP32 group commit failed, retrying %d readings one by one: %s", len(rows), e)
+        _write_each(rows)
+
+
+def _write_each(rows):
+    """Write readings one transaction each, dropping only those that fail."""
+    done = 0
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            try:
+                for row in rows:
+                    try:
+                        psycopg2.extras.execute_values(cursor, ESP32_INSERT, [row])
+                        conn.commit()
+                    except Exception as e:
+                        if conn.closed:
+                            raise
+                        conn.rollback()
+                        logger.error("ESP32 reading dropped (device=%s, user=%s): %s", row[0], row[6], e)
+                    done += 1
+            finally:
+                cursor.close()
+    except Exception as e:
+        logger.error("ESP32 retry failed, %d readings dropped: %s", len(rows) - done, e)
+
+
+def _flush_loop():
+    while True:
+        _flush_now.wait(GROUP_COMMIT_INTERVAL)
+        _flush_now.clear()
+        flush()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, daemon=True, name="esp32-group-commit")
+            _flusher.start()
+            # Don't lose the last partial group on a clean shutdown
+            atexit.register(flush)
@@ -0,0 +1,137 @@
+import logging
+import os
+import time
+import uuid
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from app.db import get_db, readonly_db
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# BACKGROUND JOBS
+# =========================
+# Slow work (Gemini analyses, profile builds) runs on a per-process thread pool,
+# but its state lives in the background_jobs table: a poll can land on any
+# worker process, and a pending job is never evicted to make room.
+# Finished results are kept this long for the client to fetch
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', '600'))
+# A job still pending after this long belonged to a process that died
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '900'))
+# Expired rows are swept at most this often, on submit
+JOB_PURGE_INTERVAL = 60
+
+_JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class BackgroundJobs:
+    """
+    A thread pool whose jobs are tracked in the database.
+
+    Job functions return (response_body, http_status). submit() refuses new
+    work once max_backlog jobs are queued or running in this process, so a
+    backed-up pool sheds load instead of growing without bound.
+    """
+
+    def __init__(self, kind, max_workers, max_backlog):
+        self.kind = kind
+        self.max_backlog = max_backlog
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=kind)
+        self._outstanding = 0
+        self._lock = Lock()
+        self._last_purge = 0.0
+
+    def submit(self, user_id, fn, *args):
+        """Queue fn(*args) for user_id. Returns the job id, or None when the backlog is full."""
+        with self._lock:
+            if self._outstanding >= self.max_backlog:
+                return None
+            self._outstanding += 1
+
+        job_id = uuid.uuid4().hex
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "INSERT INTO background_jobs (id, user_id, kind) VALUES (%s, %s, %s)",
+                        (job_id, user_id, self.kind)
+                    )
+                    self._maybe_purge(cursor)
+                    conn.commit()
+                finally:
+                    cursor.close()
+            self._executor.submit(self._run, job_id, fn, args)
+        except Exception:
+            self._release()
+            raise
+        return job_id
+
+    def result(self, job_id, user_id):
+        """
+        Look up a job owned by user_id.
+
+        Returns None for an unknown (or expired) job, (None, None) while it is
+        pending, and (http_status, result_json_text) once it has finished.
+        """
+        with readonly_db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """
+                    SELECT http_status, result::text FROM background_jobs
+                    WHERE id = %s AND user_id = %s AND kind = %s
+                      AND CASE WHEN finished_at IS NULL
+                               THEN created_at >= NOW() - make_interval(secs => %s)
+                               ELSE finished_at >= NOW() - make_interval(secs => %s) END
+                    """,
+                    (job_id, user_id, self.kind, JOB_STALE_AFTER, JOB_RESULT_TTL)
+                )
+                return cursor.fetchone()
+            finally:
+                cursor.close()
+
+    def _run(self, job_id, fn, args):
+        try:
+            try:
+                body, status = fn(*args)
+            except Exception as e:
+                logger.exception("%s job %s failed: %s", self.kind, job_id, e)
+                body, status = {"error": "server error"}, 500
+
+            with get_db() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "UPDATE background_jobs SET http_status = %s, result = %s::jsonb, finished_at = NOW() WHERE id = %s",
+                        (status, orjson.dumps(body, option=_JSON_OPTIONS).decode(), job_id)
+                    )
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            logger.error("Could not store %s job %s result: %s", self.kind, job_id, e)
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._outstanding -= 1
+
+    def _maybe_purge(self, cursor):
+        now = time.monotonic()
+        if now - self._last_purge < JOB_PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        cursor.execute(
+            """
+            DELETE FROM background_jobs
+            WHERE created_at < NOW() - make_interval(secs => %s)
+              AND CASE WHEN finished_at IS NULL
+                       THEN created_at < NOW() - make_interval(secs => %s)
+                       ELSE finished_at < NOW() - make_interval(secs => %s) END
+            """,
+            # The first bound is implied by the CASE; it lets the created_at index narrow the scan
+            (min(JOB_STALE_AFTER, JOB_RESULT_TTL), JOB_STALE_AFTER, JOB_RESULT_TTL)
+        )
@@ -0,0 +1,87 @@
+import io
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# RAW_AUDIO BULK WRITES
+# =========================
+# Frames are collected per request/batch and sent in one multi-row INSERT.
+# Callers pass epoch seconds (or None) as the first column; insert_raw_audio
+# turns them into local wall-clock times in Python for both the INSERT and the
+# COPY path, so a frame's stored time never depends on the batch size or on
+# the database session's TimeZone.
+RAW_AUDIO_INSERT = """
+    INSERT INTO raw_audio
+    (timestamp, amplitude, dominant_freq, freq_confidence, peaks, machine_id, mode, user_id)
+    VALUES %s
+"""
+# peaks arrive pre-serialized by orjson (a JSON string), hence the ::jsonb cast
+RAW_AUDIO_TEMPLATE = "(%s, %s, %s, %s, %s::jsonb, %s, %s, %s)"
+
+# Batches larger than this go through COPY instead of INSERT
+COPY_THRESHOLD = 500
+RAW_AUDIO_COPY = """
+    COPY raw_audio
+    (timestamp, amplitude, dominant_freq, freq_confidence, peaks, machine_id, mode, user_id)
+    FROM STDIN WITH (FORMAT text)
+"""
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _format_value_for_copy(value):
+    """Render one column in COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def _local_timestamps(epochs):
+    """
+    Local-time ISO strings for epoch seconds (None -> now), matching what
+    datetime.fromtimestamp() gives, converted as one NumPy array.
+    """
+    now = datetime.now().isoformat()
+    secs = np.fromiter((np.nan if e is None else e for e in epochs), dtype=np.float64, count=len(epochs))
+    known = ~np.isnan(secs)
+    out = np.full(len(secs), now, dtype=object)
+    if not known.any():
+        return out
+
+    lo, hi = float(secs[known].min()), float(secs[known].max())
+    offset = datetime.fromtimestamp(lo).astimezone().utcoffset()
+    if offset != datetime.fromtimestamp(hi).astimezone().utcoffset():
+        # The batch straddles a DST change: convert row by row
+        out[known] = [datetime.fromtimestamp(e).isoformat() for e in secs[known].tolist()]
+        return out
+
+    # Split like datetime.fromtimestamp does, so sub-microsecond rounding agrees
+    frac, whole = np.modf(secs[known])
+    micros = whole.astype(np.int64) * 1_000_000 + np.rint(frac * 1e6).astype(np.int64)
+    micros += offset // timedelta(microseconds=1)
+    out[known] = np.datetime_as_string(micros.astype("datetime64[us]"), unit="us").tolist()
+    return out
+
+
+def insert_raw_audio(cursor, rows):
+    """Write raw_audio rows, using COPY for large batches."""
+    timestamps = _local_timestamps([row[0] for row in rows])
+    if len(rows) > COPY_THRESHOLD:
+        try:
+            buf = io.StringIO()
+            for ts, row in zip(timestamps, rows):
+                buf.write("\t".join([ts, *map(_format_value_for_copy, row[1:])]))
+                buf.write("\n")
+        except (TypeError, ValueError) as e:
+            logger.warning("COPY formatting failed, falling back to INSERT: %s", e)
+        else:
+            buf.seek(0)
+            cursor.copy_expert(RAW_AUDIO_COPY, buf)
+            return
+    rows = [(ts, *row[1:]) for ts, row in zip(timestamps, rows)]
+    psycopg2.extras.execute_values(cursor, RAW_AUDIO_INSERT, rows, template=RAW_AUDIO_TEMPLATE, page_size=500)
@@ -1,3 +1,9 @@
+import numpy as np
+from bisect import bisect_right
+
+_GAS_THRESHOLDS = (800, 2000)
+_GAS_STATUSES = ("SAFE", "MODERATE", "HAZARDOUS")
+
 def process_vibration_data(vibration_samples):
     """
     Process vibration samples to generate summary metrics.
@@ -11,15 +17,17 @@ def process_vibration_data(vibration_samples):
     if not vibration_samples or len(vibration_samples) == 0:
         return None
         
-    vibration_count = sum(1 for v in vibration_samples if v == 0)
-    total_samples = len(vibration_samples)
+    # One array conversion, then the count and the mean run as NumPy reductions
+    samples = np.asarray(vibration_samples, dtype=np.float64)
+    vibration_count = int(np.count_nonzero(samples == 0))
+    total_samples = len(samples)
     
     vibration_percent = 0
     avg_raw = 0
     
     if total_samples > 0:
         vibration_percent = (1 - (vibration_count / total_samples)) * 100
-        avg_raw = sum(vibration_samples) / total_samples
+        avg_raw = float(samples.mean())
         
     return {
         "samples": total_samples,
@@ -43,31 +51,31 @@ def process_gas_data(gas_samples):
         return None
         
     # Normalize input: handle list of dicts or list of values
-    raw_values = [g.get("raw", 0) if isinstance(g, dict) else g for g in gas_samples]
-    valid_raw_values = [v for v in raw_values if v > 0]
+    raw_values = np.fromiter(
+        (g.get("raw", 0) if isinstance(g, dict) else g for g in gas_samples),
+        dtype=np.float64, count=len(gas_samples)
+    )
+    valid_raw_values = raw_values[raw_values > 0]
     
     avg_gas = 0
     max_gas = 0
     min_gas = 0
     
-    if valid_raw_values:
-        avg_gas = sum(valid_raw_values) / len(valid_raw_values)
-        max_gas = max(valid_raw_values)
-        min_gas = min(valid_raw_values)
+    if valid_raw_values.size:
+        avg_gas = float(valid_raw_values.mean())
+        max_gas = float(valid_raw_values.max())
+        min_gas = float(valid_raw_values.min())
     
     # Check gas safety status
     if avg_gas == 0: 
         gas_status = "NO_DATA"
-    elif avg_gas < 800: 
-        gas_status = "SAFE"
-    elif avg_gas < 2000: 
-        gas_status = "MODERATE"
-    else: 
-        gas_status = "HAZARDOUS"
+    else:
+        # < 800 SAFE, < 2000 MODERATE, otherwise HAZARDOUS
+        gas_status = _GAS_STATUSES[bisect_right(_GAS_THRESHOLDS, avg_gas)]
     
     return {
         "samples": len(gas_samples),
-        "valid_samples": len(valid_raw_values),
+        "valid_samples": int(valid_raw_values.size),
         "avg_raw": round(avg_gas, 1),
         "max_raw": round(max_gas, 1),
         "min_raw": round(min_gas, 1),
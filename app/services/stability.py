@@ -1,9 +1,5 @@
-# =========================
-# TEMPORAL STABILITY TRACKING (for multi-machine detection)
-# =========================
-# Track last N detections per machine for stability filtering
-STABILITY_WINDOW = 15  # Track last 15 batches
-STABILITY_THRESHOLD = 0.6  # Require 60% detection rate
+import numpy as np
+from threading import Lock
 
 # =========================
 # TEMPORAL STABILITY TRACKING (for multi-machine detection)
@@ -11,42 +7,94 @@ STABILITY_THRESHOLD = 0.6  # Require 60% detection rate
 # Track last N detections per machine for stability filtering
 STABILITY_WINDOW = 15  # Track last 15 batches
 STABILITY_THRESHOLD = 0.6  # Require 60% detection rate
+STABILITY_MIN_OBSERVATIONS = 5  # Need at least 5 observations
+
+
+class DetectionRing:
+    """
+    One user's detection history: a (machines x STABILITY_WINDOW) uint8 ring
+    written one column per batch, so updates and detection-rate scans are
+    single NumPy operations instead of a Python loop per machine.
+
+    Cells a machine has not observed yet stay 0, so a row sum is always its
+    detection count over its last `filled` observations. A machine missing
+    from an update (its profile was deleted) starts over if it comes back.
+    """
+
+    def __init__(self):
+        self.rows = {}  # machine_id -> row index
+        self.hist = np.zeros((0, STABILITY_WINDOW), dtype=np.uint8)
+        self.filled = np.zeros(0, dtype=np.int16)
+        self.ptr = 0
+        # /ingest request threads and the batch worker may update one user at once
+        self._lock = Lock()
 
-# user_id -> { machine_id -> [list of history] }
+    def _row_indices(self, machine_ids):
+        new = [m for m in machine_ids if m not in self.rows]
+        if new:
+            n = len(self.rows)
+            for offset, machine_id in enumerate(new):
+                self.rows[machine_id] = n + offset
+            self.hist = np.vstack((self.hist, np.zeros((len(new), STABILITY_WINDOW), dtype=np.uint8)))
+            self.filled = np.concatenate((self.filled, np.zeros(len(new), dtype=np.int16)))
+        return np.fromiter((self.rows[m] for m in machine_ids), dtype=np.intp, count=len(machine_ids))
+
+    def update(self, running_machines, all_machines):
+        with self._lock:
+            idx = self._row_indices(all_machines)
+            present = np.zeros(len(self.filled), dtype=bool)
+            present[idx] = True
+            self.filled[~present] = 0
+            # Rows (re)starting now must not see detections from an earlier run
+            self.hist[idx[self.filled[idx] == 0]] = 0
+
+            detected = np.fromiter((m in running_machines for m in all_machines), dtype=bool, count=len(all_machines))
+            self.hist[idx, self.ptr] = detected
+            self.filled[idx] = np.minimum(self.filled[idx] + 1, STABILITY_WINDOW)
+            self.ptr = (self.ptr + 1) % STABILITY_WINDOW
+
+    def _known(self, all_machines):
+        machine_ids = [m for m in all_machines if m in self.rows]
+        idx = np.fromiter((self.rows[m] for m in machine_ids), dtype=np.intp, count=len(machine_ids))
+        return machine_ids, idx
+
+    def stable(self, all_machines):
+        with self._lock:
+            machine_ids, idx = self._known(all_machines)
+            filled = self.filled[idx]
+            rates = self.hist[idx].sum(axis=1) / np.maximum(filled, 1)
+            keep = (filled >= STABILITY_MIN_OBSERVATIONS) & (rates >= STABILITY_THRESHOLD)
+        return [m for m, k in zip(machine_ids, keep.tolist()) if k]
+
+    def last_detected(self, all_machines):
+        with self._lock:
+            machine_ids, idx = self._known(all_machines)
+            keep = (self.filled[idx] > 0) & (self.hist[idx, (self.ptr - 1) % STABILITY_WINDOW] == 1)
+        return [m for m, k in zip(machine_ids, keep.tolist()) if k]
+
+
+# user_id -> DetectionRing
 detection_history = {}
+_history_lock = Lock()
 
 def update_detection_history(user_id, running_machines, all_machines_in_profile):
     """Update detection history for temporal stability filtering per user"""
-    if user_id not in detection_history:
-        detection_history[user_id] = {}
-        
-    user_history = detection_history[user_id]
-        
-    for machine_id in all_machines_in_profile:
-        if machine_id not in user_history:
-            user_history[machine_id] = []
-        
-        detected = 1 if machine_id in running_machines else 0
-        user_history[machine_id].append(detected)
-        
-        # Keep only last STABILITY_WINDOW entries
-        if len(user_history[machine_id]) > STABILITY_WINDOW:
-            user_history[machine_id].pop(0)
+    ring = detection_history.get(user_id)
+    if ring is None:
+        with _history_lock:
+            ring = detection_history.setdefault(user_id, DetectionRing())
+    ring.update(running_machines, list(all_machines_in_profile))
 
 def get_stable_machines(user_id, all_machines_in_profile):
     """Return only machines detected in ≥60% of last STABILITY_WINDOW batches for this user"""
-    if user_id not in detection_history:
+    ring = detection_history.get(user_id)
+    if ring is None:
+        return []
+    return ring.stable(all_machines_in_profile)
+
+def get_detected_machines(user_id, all_machines_in_profile):
+    """Return the machines detected in this user's most recent batch"""
+    ring = detection_history.get(user_id)
+    if ring is None:
         return []
-        
-    user_history = detection_history[user_id]
-    stable = []
-    
-    for machine_id in all_machines_in_profile:
-        if machine_id not in user_history or len(user_history[machine_id]) < 5:
-            continue  # Need at least 5 observations
-        
-        detection_rate = sum(user_history[machine_id]) / len(user_history[machine_id])
-        if detection_rate >= STABILITY_THRESHOLD:
-            stable.append(machine_id)
-    
-    return stable
+    return ring.last_detected(all_machines_in_profile)
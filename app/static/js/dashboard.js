@@ -5,6 +5,8 @@ const BACKEND_URL = `${window.location.origin}`;
 const CALIBRATION_DURATION = 60;
 const AMPLITUDE_THRESHOLD = 0.5;
 const CONFIDENCE_THRESHOLD = 0.08;
+// Profile builds are polled every 500 ms; give up after two minutes
+const MAX_PROFILE_POLLS = 240;
 
 // Gas thresholds for display
 const GAS_SAFE_LIMIT = 300;
@@ -1146,7 +1148,22 @@ async function saveProfile() {
             body: JSON.stringify(payload)
         });
 
-        const result = await response.json();
+        let result = await response.json();
+        if (!response.ok && !result.error) result.error = `HTTP ${response.status}`;
+
+        // The profile is built in the background; poll until it is ready
+        let polls = 0;
+        while (result.status === 'pending') {
+            if (++polls > MAX_PROFILE_POLLS) {
+                result = { error: 'Profile build timed out, please try again' };
+                break;
+            }
+            updateStatus('calibration', '⏳ Building profile...', 'info');
+            await new Promise(resolve => setTimeout(resolve, 500));
+            const poll = await fetch(BACKEND_URL + '/save_profile/' + result.job_id);
+            result = await poll.json();
+            if (!poll.ok && !result.error) result.error = `HTTP ${poll.status}`;
+        }
 
         if (result.status === 'profile_saved') {
             updateStatus('calibration', `✅ Profile saved! Median: ${result.median_freq} Hz, ${result.bands_count} bands`, 'success');
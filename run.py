@@ -1,11 +1,48 @@
-from app import create_app
-from app.db import ensure_db_schema
-from app.services.batch_processor import start_worker
+import atexit
 import os
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from dotenv import load_dotenv
 
+# Load .env before importing the app: modules read their settings at import time
 load_dotenv()
 
+from app import create_app
+from app.db import ensure_db_schema
+from app.services.batch_processor import start_worker
+
+def configure_logging():
+    """
+    Route every log record through a queue: request threads and batch workers
+    only enqueue, and one listener thread does the formatting and the console
+    and (rotating) file writes.
+    """
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    handlers = [logging.StreamHandler()]
+    log_file = os.getenv('LOG_FILE', 'server.log')
+    if log_file:
+        handlers.append(RotatingFileHandler(
+            log_file,
+            maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+            backupCount=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+            encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    root.handlers[:] = [QueueHandler(log_queue)]
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+configure_logging()
+
 app = create_app()
 
 if __name__ == "__main__":
@@ -19,4 +56,4 @@ if __name__ == "__main__":
     start_worker()
     
     # Run server
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=app.debug)
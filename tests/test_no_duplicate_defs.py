@@ -0,0 +1,38 @@
+"""Guard against the same function, class or constant being defined twice in one module.
+
+A second top-level definition silently replaces the first at import time, so
+duplicated blocks (e.g. a pasted copy of create_app or of the stability
+constants) change behaviour without any error.
+"""
+import ast
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+MODULES = sorted(APP_DIR.rglob("*.py"))
+
+
+def _top_level_names(tree):
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            yield node.name
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    yield target.id
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            yield node.target.id
+
+
+def test_modules_found():
+    assert MODULES, f"no modules found under {APP_DIR}"
+
+
+@pytest.mark.parametrize("path", MODULES, ids=lambda p: str(p.relative_to(APP_DIR.parent)))
+def test_no_duplicate_top_level_definitions(path):
+    tree = ast.parse(path.read_text(encoding="utf-8"), filename=str(path))
+    counts = Counter(_top_level_names(tree))
+    duplicates = sorted(name for name, n in counts.items() if n > 1)
+    assert not duplicates, f"{path.name} defines {', '.join(duplicates)} more than once"